@@ -0,0 +1,198 @@
+"""A minimal local HTTP endpoint to inspect and manage a running function-pythonic."""
+
+import asyncio
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import sys
+import time
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+class Admin:
+    """Serves json runtime state, and POST actions to invalidate classes and capture profiles.
+
+    GET  /                   All of the following
+    GET  /classes            Cached composite classes and their hit counts
+    GET  /packages           Loaded ConfigMap and Secret packages and their content hashes
+    GET  /requests           In flight requests and recent slow requests
+    POST /invalidate         Clear the class cache, ?module=name also unloads the module
+    POST /profile?xr=name    Profile the next compose of the XR, requires --profile-dir
+    POST /profile?enabled=0  Disable or enable (1) compose profiling
+
+    If a token is given, every request requires an "Authorization: Bearer <token>" header.
+    Binding to an address other than loopback requires a token.
+    """
+
+    def __init__(self, runner, token=None):
+        self.runner = runner
+        self.token = token
+
+    async def start(self, address):
+        host, port = address.rsplit(':', 1)
+        host = host.strip('[]') or '127.0.0.1'
+        if not self.token and not loopback(host):
+            raise ValueError(f"Admin endpoint address {address} is not loopback and requires a token")
+        self.server = await asyncio.start_server(self.handle, host, int(port), limit=MAX_LINE)
+        logger.info(f"Admin endpoint listening on {address}")
+        return self.server
+
+    async def handle(self, reader, writer):
+        try:
+            method, target, headers = await self.read(reader)
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if self.token and not authorized(headers.get('authorization', ''), self.token):
+                raise RequestError(401, 'Unauthorized')
+            status, body = self.route(method, url.path.rstrip('/') or '/', query)
+        except RequestError as e:
+            status, body = e.status, {'error': e.message}
+        except Exception as e:
+            logger.exception('Admin request exception')
+            status, body = 500, {'error': str(e)}
+        body = json.dumps(body, indent=2, default=str).encode('utf-8') + b'\n'
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS.get(status, '')}\r\n"
+            'Content-Type: application/json\r\n'
+            f"Content-Length: {len(body)}\r\n"
+            'Connection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def read(self, reader):
+        """Read the request line and headers, within the READ_TIMEOUT and size limits."""
+        try:
+            async with asyncio.timeout(READ_TIMEOUT):
+                request = await reader.readline()
+                headers = {}
+                for count in itertools.count():
+                    line = (await reader.readline()).strip()
+                    if not line:
+                        break
+                    if count >= MAX_HEADERS:
+                        raise RequestError(431, 'Too many headers')
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+            method, target, _ = request.decode('latin-1').split(' ', 2)
+        except TimeoutError:
+            raise RequestError(408, 'Request timeout') from None
+        except ValueError:
+            # A line longer than MAX_LINE, or a malformed request line
+            raise RequestError(400, 'Bad request') from None
+        return method, target, headers
+
+    def route(self, method, path, query):
+        if method == 'GET':
+            if path == '/':
+                return 200, {
+                    'classes': self.classes(),
+                    'packages': self.packages(),
+                    'requests': self.requests(),
+                }
+            if path == '/classes':
+                return 200, self.classes()
+            if path == '/packages':
+                return 200, self.packages()
+            if path == '/requests':
+                return 200, self.requests()
+        elif method == 'POST':
+            if path == '/invalidate':
+                module = query.get('module')
+                self.runner.invalidate_module(module)
+                logger.info(f"Admin invalidated {module or 'class cache'}")
+                return 200, {'invalidated': module or 'classes'}
+            if path == '/profile':
+                return self.profile(query)
+        else:
+            return 405, {'error': f"Method not allowed: {method}"}
+        return 404, {'error': f"Not found: {path}"}
+
+    def classes(self):
+        return [
+            {
+                'class': self.runner.names.get(key, key),
+                'hits': self.runner.hits.get(key, 0),
+            }
+            for key in self.runner.clazzes
+        ]
+
+    def packages(self):
+        # Only present if --packages imported the package operator
+        packages = sys.modules.get('crossplane.pythonic.packages')
+        if packages is None:
+            return {}
+        return packages.PACKAGES
+
+    def requests(self):
+        now = time.monotonic()
+        return {
+            'inflight': [
+                dict(fields, seconds=round(now - started, 6))
+                for started, fields in self.runner.inflight.values()
+            ],
+            'slowSeconds': self.runner.slowSeconds,
+            'slow': list(self.runner.slowRequests),
+        }
+
+    def profile(self, query):
+        profiler = self.runner.profiler
+        if not profiler.directory:
+            return 409, {'error': 'Profiling requires --profile-dir'}
+        if 'enabled' in query:
+            profiler.enabled = query['enabled'].lower() in ('1', 'true', 'yes')
+        if 'xr' in query:
+            profiler.enabled = True
+            profiler.armed.add(query['xr'])
+        return 200, {
+            'enabled': profiler.enabled,
+            'armed': sorted(profiler.armed),
+            'profiled': profiler.profiled,
+        }
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def authorized(authorization, token):
+    scheme, _, credentials = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode('utf-8'), token.encode('utf-8'))
+
+
+# Seconds to read the request line and headers, and the limits on their size
+READ_TIMEOUT = 5.0
+MAX_LINE = 8192
+MAX_HEADERS = 100
+
+STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    409: 'Conflict',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
@@ -0,0 +1,74 @@
+"""A bytecode cache kept outside of the source directories.
+
+Compiled code is stored in a writable cache directory keyed by a digest of the source,
+so read only or mismatched uid package volumes still avoid recompiling on every import.
+"""
+
+import builtins
+import hashlib
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import pathlib
+import sys
+
+
+CACHE_DIR = None
+
+
+def install(cache_dir):
+    """Cache compiled python source files and inline scripts in the cache directory."""
+    global CACHE_DIR
+    CACHE_DIR = pathlib.Path(cache_dir).expanduser().resolve()
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    for hook in sys.path_hooks:
+        if getattr(hook, 'bytecode_cache', False):
+            break
+    else:
+        hook = importlib.machinery.FileFinder.path_hook(
+            (CachedSourceFileLoader, importlib.machinery.SOURCE_SUFFIXES),
+            (importlib.machinery.ExtensionFileLoader, importlib.machinery.EXTENSION_SUFFIXES),
+            (importlib.machinery.SourcelessFileLoader, importlib.machinery.BYTECODE_SUFFIXES),
+        )
+        hook.bytecode_cache = True
+        # Ahead of the default FileFinder hook, after zipimport
+        sys.path_hooks.insert(len(sys.path_hooks) - 1 if sys.path_hooks else 0, hook)
+    sys.path_importer_cache.clear()
+    importlib.invalidate_caches()
+
+
+def compile(source, filename):
+    """Compile source for exec, reusing the cached code object if the source was compiled before."""
+    if CACHE_DIR is None:
+        return builtins.compile(source, filename, 'exec', dont_inherit=True)
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    digest = hashlib.sha256()
+    digest.update(sys.implementation.cache_tag.encode('utf-8'))
+    digest.update(b'\0' + filename.encode('utf-8') + b'\0')
+    digest.update(source)
+    digest = digest.hexdigest()
+    path = CACHE_DIR / digest[:2] / digest
+    try:
+        return marshal.loads(path.read_bytes())
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    code = builtins.compile(importlib.util.decode_source(source), filename, 'exec', dont_inherit=True)
+    try:
+        path.parent.mkdir(exist_ok=True)
+        temp = path.with_name(f"{digest}.{os.getpid()}")
+        temp.write_bytes(marshal.dumps(code))
+        temp.replace(path)
+    except OSError:
+        pass
+    return code
+
+
+class CachedSourceFileLoader(importlib.machinery.SourceFileLoader):
+    def source_to_code(self, data, path, *, _optimize=-1):
+        return compile(data, path)
+
+    def set_data(self, path, data, *, _mode=0o666):
+        # Never write __pycache__ next to the source
+        pass
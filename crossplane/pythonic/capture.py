@@ -0,0 +1,171 @@
+"""Sampled capture of RunFunction requests and their responses, see replay.py."""
+
+import datetime
+import gzip
+import logging
+import os
+import pathlib
+import queue
+import random
+import threading
+
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from . import function
+
+
+logger = logging.getLogger(__name__)
+
+REDACTED = b'<<REDACTED>>'
+
+
+class Capture:
+    """Writes sampled requests and their responses to rotating gzip files from a background thread.
+
+    Each record is a varint length prefixed RunFunctionRequest followed by its varint length
+    prefixed RunFunctionResponse. Credentials, connection details, and Secret data are redacted
+    in both. Records are dropped rather than queued without bound if writing falls behind.
+    """
+
+    def __init__(self, directory, sample=1.0, fileSize=64 * 1024 * 1024, files=10, queued=1000):
+        self.directory = pathlib.Path(directory).expanduser()
+        self.sample = sample
+        self.fileSize = fileSize
+        self.files = files
+        self.records = queue.Queue(queued)
+        self.captured = 0
+        self.dropped = 0
+        self.thread = None
+
+    def request(self, request):
+        """Return the redacted serialized request if it is sampled, otherwise None.
+
+        Requests are composed in place, so they are serialized before being run.
+        """
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return None
+        copy = fnv1.RunFunctionRequest()
+        copy.CopyFrom(request)
+        redact(copy)
+        return copy.SerializeToString()
+
+    def response(self, response):
+        """Return the redacted serialized copy of a sampled function.Response."""
+        copy = response.message()
+        redact(copy)
+        return copy.SerializeToString()
+
+    def write(self, request, response):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='pythonic-capture', daemon=True)
+            self.thread.start()
+        try:
+            self.records.put_nowait((request, response))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+            logger.info(f"Captured {self.captured} requests, dropped {self.dropped}")
+
+    def run(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        output = None
+        size = 0
+        try:
+            while True:
+                record = self.records.get()
+                if record is None:
+                    break
+                if output is None or size >= self.fileSize:
+                    if output is not None:
+                        output.close()
+                    output = self.open()
+                    size = 0
+                for message in record:
+                    output.write(function.varint(len(message)))
+                    output.write(message)
+                    size += len(message)
+                self.captured += 1
+                if self.records.empty():
+                    # Keep the file readable while capturing
+                    output.flush()
+        except OSError as e:
+            logger.error(f"Request capture failed: {e}")
+        finally:
+            if output is not None:
+                output.close()
+
+    def open(self):
+        # Remove the oldest files, keeping the newest files - 1 and the new file
+        existing = sorted(self.directory.glob('capture-*.binpb.gz'))
+        for old in existing[:max(len(existing) - self.files + 1, 0)]:
+            old.unlink(missing_ok=True)
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S.%f')
+        path = self.directory / f"capture-{timestamp}-{os.getpid()}.binpb.gz"
+        logger.info(f"Capturing requests to {path}")
+        return gzip.open(path, 'wb')
+
+
+def redact(message):
+    """Redact a RunFunctionRequest or RunFunctionResponse in place."""
+    resources = [message.desired.composite, *message.desired.resources.values()]
+    if isinstance(message, fnv1.RunFunctionRequest):
+        for credentials in message.credentials.values():
+            for key in credentials.credential_data.data:
+                credentials.credential_data.data[key] = REDACTED
+        resources.append(message.observed.composite)
+        resources.extend(message.observed.resources.values())
+        for extra in message.extra_resources.values():
+            resources.extend(extra.items)
+        for required in message.required_resources.values():
+            resources.extend(required.items)
+    for resource in resources:
+        for key in resource.connection_details:
+            resource.connection_details[key] = REDACTED
+        fields = resource.resource.fields
+        if 'kind' in fields and fields['kind'].string_value == 'Secret':
+            for field in ('data', 'stringData'):
+                if field in fields:
+                    values = fields[field].struct_value.fields
+                    for key in values:
+                        values[key].string_value = REDACTED.decode('utf-8')
+
+
+def read(path):
+    """Yield the (request, response) serialized messages of a capture file.
+
+    A file whose process ended while writing ends at its last complete record.
+    """
+    with gzip.open(path, 'rb') as input:
+        try:
+            while True:
+                request = readMessage(input)
+                if request is None:
+                    break
+                response = readMessage(input)
+                if response is None:
+                    break
+                yield request, response
+        except (EOFError, gzip.BadGzipFile):
+            return
+
+
+def readMessage(input):
+    length = 0
+    shift = 0
+    while True:
+        byte = input.read(1)
+        if not byte:
+            return None
+        length |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            break
+        shift += 7
+    message = input.read(length)
+    if len(message) < length:
+        return None
+    return message
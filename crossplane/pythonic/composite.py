@@ -1,38 +1,95 @@
 
 import datetime
+import functools
 from crossplane.function.proto.v1 import run_function_pb2 as fnv1
 
-from . import protobuf
+from . import protobuf, tracing
 
 
 _notset = object()
 
 
 class BaseComposite:
+    requiredResources = None
+
     def __init__(self, request, response, logger):
-        self.request = protobuf.Message(None, 'request', request.DESCRIPTOR, request, 'Function Request')
-        self.response = protobuf.Message(None, 'response', response.DESCRIPTOR, response)
+        if isinstance(request, protobuf.Message):
+            self.request = request
+        else:
+            self.request = protobuf.Message(None, 'request', request.DESCRIPTOR, request, 'Function Request')
+        if isinstance(response, protobuf.Message):
+            self.response = response
+        else:
+            self.response = protobuf.Message(None, 'response', response.DESCRIPTOR, response)
         self.logger = logger
-        self.credentials = Credentials(self.request)
-        self.context = self.response.context
-        self.environment = self.context['apiextensions.crossplane.io/environment']
-        self.requireds = Requireds(self)
-        self.resources = Resources(self)
         self.unknownsFatal = True
         self.autoReady = True
 
-        observed = self.request.observed.composite
-        desired = self.response.desired.composite
-        self.observed = observed.resource
-        self.desired = desired.resource
-        self.apiVersion = self.observed.apiVersion
-        self.kind = self.observed.kind
-        self.metadata = self.observed.metadata
-        self.spec = self.observed.spec
-        self.status = Status(self.observed.status, self.desired.status)
-        self.conditions = Conditions(observed, self.response)
-        self.connection = Connection(observed, desired)
-        self.events = Events(self.response)
+    def span(self, name, **attributes):
+        """Trace a section of compose, for example: with self.span('buckets', count=3): ..."""
+        return tracing.span(name, **attributes)
+
+    # The remaining helpers are created on first access, many composes only use a few of them
+
+    @functools.cached_property
+    def credentials(self):
+        return Credentials(self.request)
+
+    @functools.cached_property
+    def context(self):
+        return self.response.context
+
+    @functools.cached_property
+    def environment(self):
+        return self.context['apiextensions.crossplane.io/environment']
+
+    @functools.cached_property
+    def requireds(self):
+        return Requireds(self)
+
+    @functools.cached_property
+    def resources(self):
+        return Resources(self)
+
+    @functools.cached_property
+    def observed(self):
+        return self.request.observed.composite.resource
+
+    @functools.cached_property
+    def desired(self):
+        return self.response.desired.composite.resource
+
+    @functools.cached_property
+    def apiVersion(self):
+        return self.observed.apiVersion
+
+    @functools.cached_property
+    def kind(self):
+        return self.observed.kind
+
+    @functools.cached_property
+    def metadata(self):
+        return self.observed.metadata
+
+    @functools.cached_property
+    def spec(self):
+        return self.observed.spec
+
+    @functools.cached_property
+    def status(self):
+        return Status(self.observed.status, self.desired.status)
+
+    @functools.cached_property
+    def conditions(self):
+        return Conditions(self.request.observed.composite, self.response)
+
+    @functools.cached_property
+    def connection(self):
+        return Connection(self.request.observed.composite, self.response.desired.composite)
+
+    @functools.cached_property
+    def events(self):
+        return Events(self.response)
 
     @property
     def ttl(self):
@@ -228,12 +285,17 @@ class Resource:
 class Requireds:
     def __init__(self, composite):
         self._composite = composite
+        self._cache = {}
 
     def __getattr__(self, key):
         return self[key]
 
     def __getitem__(self, key):
-        return RequiredResources(self._composite, key)
+        required = self._cache.get(key)
+        if required is None:
+            required = RequiredResources(self._composite, key)
+            self._cache[key] = required
+        return required
 
     def __bool__(self):
         return bool(len(self))
@@ -268,6 +330,7 @@ class RequiredResources:
         self.name = name
         self._selector = composite.response.requirements.extra_resources[name]
         self._resources = composite.request.extra_resources[name]
+        self._indexes = None
 
     def __call__(self, apiVersion=_notset, kind=_notset, namespace=_notset, name=_notset, labels=_notset):
         self._selector()
@@ -342,6 +405,60 @@ class RequiredResources:
         for ix in range(len(self)):
             yield self[ix]
 
+    def byName(self, name, namespace=_notset):
+        names, qualified, namespaces, labels = self._index()
+        if namespace == _notset:
+            ixs = names.get(str(name))
+        else:
+            ixs = qualified.get((str(name), str(namespace)))
+        return self[ixs[0] if ixs else len(self)]
+
+    def byNamespace(self, namespace):
+        names, qualified, namespaces, labels = self._index()
+        return [self[ix] for ix in namespaces.get(str(namespace), ())]
+
+    def where(self, namespace=_notset, labels=_notset):
+        names, qualified, namespaces, indexes = self._index()
+        matches = None
+        if namespace != _notset:
+            matches = set(namespaces.get(str(namespace), ()))
+        if labels != _notset and labels:
+            for entry in labels:
+                if isinstance(entry, str):
+                    entry = (entry, labels[entry])
+                ixs = indexes.get((str(entry[0]), str(entry[1])), ())
+                matches = set(ixs) if matches is None else matches.intersection(ixs)
+        if matches is None:
+            return list(self)
+        return [self[ix] for ix in sorted(matches)]
+
+    def _index(self):
+        # Indexes are built once directly from the protobuf items so only matched items get wrapped
+        if self._indexes is None:
+            names = {}
+            qualified = {}
+            namespaces = {}
+            labels = {}
+            if self._resources:
+                for ix, item in enumerate(self._resources._message.items):
+                    metadata = item.resource.fields.get('metadata')
+                    if metadata is None:
+                        continue
+                    metadata = metadata.struct_value.fields
+                    value = metadata.get('namespace')
+                    namespace = '' if value is None else value.string_value
+                    namespaces.setdefault(namespace, []).append(ix)
+                    value = metadata.get('name')
+                    if value is not None:
+                        names.setdefault(value.string_value, []).append(ix)
+                        qualified.setdefault((value.string_value, namespace), []).append(ix)
+                    value = metadata.get('labels')
+                    if value is not None:
+                        for key, label in value.struct_value.fields.items():
+                            labels.setdefault((key, label.string_value), []).append(ix)
+            self._indexes = (names, qualified, namespaces, labels)
+        return self._indexes
+
 
 class RequiredResource:
     def __init__(self, name, resource):
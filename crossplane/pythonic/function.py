@@ -3,16 +3,23 @@
 import asyncio
 import base64
 import builtins
+import collections
+import contextvars
+import hashlib
 import importlib
 import inspect
+import itertools
 import logging
+import pathlib
 import sys
+import time
 
 import grpc
-import crossplane.function.response
 from crossplane.function.proto.v1 import run_function_pb2 as fnv1
 from crossplane.function.proto.v1 import run_function_pb2_grpc as grpcv1
+from google.protobuf import struct_pb2
 from .. import pythonic
+from . import bytecode, memory, profiling, protobuf, tracing
 
 builtins.BaseComposite = pythonic.BaseComposite
 builtins.append = pythonic.append
@@ -26,6 +33,9 @@ builtins.B64Decode = pythonic.B64Decode
 
 logger = logging.getLogger(__name__)
 
+# Fields of the RunFunction being served, added to log records of the serving task
+LOG_FIELDS = contextvars.ContextVar('LOG_FIELDS', default=None)
+
 
 class FunctionRunner(grpcv1.FunctionRunnerService):
     """A FunctionRunner handles gRPC RunFunctionRequests."""
@@ -34,23 +44,141 @@ class FunctionRunner(grpcv1.FunctionRunnerService):
         """Create a new FunctionRunner."""
         self.debug = debug
         self.clazzes = {}
+        self.hits = {}
+        # Names of the cached classes in logs, profiles and reports, see className
+        self.names = {}
+        # Requests being composed by sequence number, and recent requests slower than slowSeconds
+        self.inflight = {}
+        self.sequence = itertools.count()
+        # Set when the in-flight request completes, for the requests being waited on
+        self.completions = {}
+        self.slowSeconds = 1.0
+        self.slowRequests = collections.deque(maxlen=50)
+        # Modules imported when loading composite classes
+        self.modules = set()
+        self.profiler = profiling.Profiler()
+        self.memory = memory.MemoryProfiler()
+        # Sampled request capture, see capture.py
+        self.capture = None
+
+    def invalidate_module(self, module=None):
+        self.invalidate_modules([module] if module else [])
+
+    def invalidate_modules(self, modules):
+        """Unload the modules as a single batch, clearing their classes from the class cache.
 
-    def invalidate_module(self, module):
-        self.clazzes.clear()
-        if module in sys.modules:
-            del sys.modules[module]
+        Without modules the whole class cache is cleared. Inline scripts are always cleared, as
+        they may import the modules, and compiled again by the next request which uses them.
+        Returns the cached composite classes of the unloaded modules, see reload.
+        """
+        modules = set(modules)
+        composites = []
+        for composite in list(self.clazzes):
+            if '\n' not in composite:
+                if modules and composite.rsplit('.', 1)[0] not in modules:
+                    continue
+                composites.append(composite)
+            del self.clazzes[composite]
+            self.hits.pop(composite, None)
+            self.names.pop(composite, None)
+        for module in modules:
+            self.modules.discard(module)
+            sys.modules.pop(module, None)
         importlib.invalidate_caches()
+        return composites
+
+    async def reload(self, composites):
+        """Load the composite classes again ahead of requests, returning the number loaded.
+
+        Loading runs on the event loop thread, so a class is never loaded by two requests at
+        once, and control is yielded to requests between classes. Classes a request loaded
+        first are skipped.
+        """
+        loaded = 0
+        for composite in composites:
+            await asyncio.sleep(0)
+            if composite in self.clazzes:
+                loaded += 1
+                continue
+            clazz, _ = self.get_clazz(composite, logger)
+            if clazz:
+                self.hits[composite] = 0
+                loaded += 1
+        return loaded
+
+    def add_to_server(self, server):
+        """Register with a gRPC server, serializing Responses without copying the desired state.
+
+        The received request bytes are kept, see Received.
+        """
+        handlers = {
+            'RunFunction': grpc.unary_unary_rpc_method_handler(
+                self.ServeReceived,
+                request_deserializer=received,
+                response_serializer=Response.SerializeToString,
+            ),
+        }
+        server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(SERVICE_NAME, handlers),))
+        server.add_registered_method_handlers(SERVICE_NAME, handlers)
 
     async def RunFunction(
-        self, request: fnv1.RunFunctionRequest, _: grpc.aio.ServicerContext
+        self, request: fnv1.RunFunctionRequest, context: grpc.aio.ServicerContext
     ) -> fnv1.RunFunctionResponse:
+        return (await self.ServeFunction(request, context)).message()
+
+    async def ServeReceived(self, received, context: grpc.aio.ServicerContext) -> 'Response':
+        request, data = received
+        return await self.ServeFunction(request, context, data)
+
+    async def ServeFunction(
+        self, request: fnv1.RunFunctionRequest, _: grpc.aio.ServicerContext, data=None
+    ) -> 'Response':
+        captured = self.capture.request(request) if self.capture is not None else None
         try:
-            return await self.run_function(request)
+            response = Response(request, await self.run_function(request, data))
         except:
             logger.exception('Exception thrown in run fuction')
             raise
+        if captured is not None:
+            self.capture.write(captured, self.capture.response(response))
+        return response
 
-    async def run_function(self, request):
+    async def run_function(self, request, data=None):
+        """Compose the request in place, data is the serialized request if it was received as bytes."""
+        fields = {}
+        token = LOG_FIELDS.set(fields)
+        started = time.monotonic()
+        # Unlike id(request), never reused while a package generation waits for these to complete
+        sequence = next(self.sequence)
+        self.inflight[sequence] = (started, fields)
+        try:
+            with tracing.span('RunFunction') as span:
+                response = await self.compose_function(request, fields, data)
+                for key, value in fields.items():
+                    span[key] = value
+                return response
+        finally:
+            LOG_FIELDS.reset(token)
+            self.completed(sequence)
+            seconds = time.monotonic() - started
+            if seconds > self.slowSeconds:
+                self.slowRequests.append(dict(fields, seconds=round(seconds, 6), finished=time.time()))
+
+    def completed(self, sequence):
+        del self.inflight[sequence]
+        event = self.completions.pop(sequence, None)
+        if event is not None:
+            event.set()
+
+    async def wait_inflight(self, sequences):
+        """Wait until the in-flight requests with the sequence numbers have completed."""
+        for sequence in sequences:
+            if sequence in self.inflight:
+                await self.completions.setdefault(sequence, asyncio.Event()).wait()
+
+    async def compose_function(self, request, fields, data=None):
+        # Composites read the desired state and context as received, not as composed in place
+        received = Received(request, data)
         composite = request.observed.composite.resource
         name = list(reversed(composite['apiVersion'].split('/')[0].split('.')))
         name.append(composite['kind'])
@@ -60,124 +188,108 @@ class FunctionRunner(grpcv1.FunctionRunnerService):
             request.context['iteration'] = request.context['iteration'] + 1
         else:
             request.context['iteration'] = 1
+        fields['xr'] = '/'.join((composite['apiVersion'], composite['kind'], composite['metadata']['name']))
+        fields['iteration'] = int(request.context['iteration'])
+        if request.meta.tag:
+            fields['tag'] = request.meta.tag
         logger.debug(f"Starting compose, {ordinal(request.context['iteration'])} pass")
 
-        response = crossplane.function.response.to(request)
+        # The desired state and context are composed in place in the request, see Response
+        response = fnv1.RunFunctionResponse(meta=fnv1.ResponseMeta(tag=request.meta.tag))
+        response.meta.ttl.seconds = DEFAULT_TTL
 
-        if composite['apiVersion'] == 'pythonic.fortra.com/v1alpha1' and composite['kind'] == 'Composite':
-            if 'composite' not in composite['spec']:
-                logger.error('Missing spec "composite"')
-                crossplane.function.response.fatal(response, 'Missing spec "composite"')
-                return response
-            composite = composite['spec']['composite']
-        else:
-            if 'composite' not in request.input:
-                logger.error('Missing input "composite"')
-                crossplane.function.response.fatal(response, 'Missing input "composite"')
-                return response
-            composite = request.input['composite']
-
-        clazz = self.clazzes.get(composite)
-        if not clazz:
-            if '\n' in composite:
-                module = Module()
-                try:
-                    exec(composite, module.__dict__)
-                except Exception as e:
-                    logger.exception('Exec exception')
-                    crossplane.function.response.fatal(response, f"Exec exception: {e}")
+        with tracing.span('input'):
+            if composite['apiVersion'] == 'pythonic.fortra.com/v1alpha1' and composite['kind'] == 'Composite':
+                if 'composite' not in composite['spec']:
+                    logger.error('Missing spec "composite"')
+                    fatal(response, 'Missing spec "composite"')
                     return response
-                composite = ['<script>', 'Composite']
+                composite = composite['spec']['composite']
             else:
-                composite = composite.rsplit('.', 1)
-                if len(composite) == 1:
-                    logger.error(f"Composite class name does not include module: {composite[0]}")
-                    crossplane.function.response.fatal(response, f"Composite class name does not include module: {composite[0]}")
+                if 'composite' not in request.input:
+                    logger.error('Missing input "composite"')
+                    fatal(response, 'Missing input "composite"')
                     return response
+                composite = request.input['composite']
+
+        with tracing.span('load'):
+            clazz, error = self.get_clazz(composite, logger)
+        if not clazz:
+            fatal(response, error)
+            return response
+        fields['class'] = self.names[composite]
+
+        if clazz.requiredResources is not None:
+            with tracing.span('requireds.declared'):
                 try:
-                    module = importlib.import_module(composite[0])
+                    self.declareRequireds(clazz, request, response)
                 except Exception as e:
-                    logger.error(str(e))
-                    crossplane.function.response.fatal(response, f"Import module exception: {e}")
+                    logger.exception('Required resources exception')
+                    fatal(response, f"Required resources exception: {e}")
+                    return response
+                requested = self.requestRequireds(request, response)
+                if requested:
+                    logger.info(f"Requireds requested: {','.join(requested)}")
                     return response
-            clazz = getattr(module, composite[1], None)
-            if not clazz:
-                logger.error(f"{composite[0]} did not define: {composite[1]}")
-                crossplane.function.response.fatal(response, f"{composite[0]} did not define: {composite[1]}")
-                return response
-            composite = '.'.join(composite)
-            if not inspect.isclass(clazz):
-                logger.error(f"{composite} is not a class")
-                crossplane.function.response.fatal(response, f"{composite} is not a class")
-                return response
-            if not issubclass(clazz, BaseComposite):
-                logger.error(f"{composite} is not a subclass of BaseComposite")
-                crossplane.function.response.fatal(response, f"{composite} is not a subclass of BaseComposite")
-                return response
-            self.clazzes[composite] = clazz
 
-        try:
-            composite = clazz(request, response, logger)
-        except Exception as e:
-            logger.exception('Instatiate exception')
-            crossplane.function.response.fatal(response, f"Instatiate exception: {e}")
-            return response
+        with tracing.span('instantiate'):
+            try:
+                composite = clazz(RequestMessage(request, received), responseMessage(request, response), logger)
+            except Exception as e:
+                logger.exception('Instatiate exception')
+                fatal(response, f"Instatiate exception: {e}")
+                return response
 
-        try:
-            result = composite.compose()
-            if asyncio.iscoroutine(result):
-                await result
-        except Exception as e:
-            logger.exception('Compose exception')
-            crossplane.function.response.fatal(response, f"Compose exception: {e}")
-            return response
+        with (
+            tracing.span('compose'),
+            self.profiler.compose(fields['xr'], fields['class']),
+            self.memory.compose(fields['class'], clazz),
+        ):
+            try:
+                result = composite.compose()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.exception('Compose exception')
+                fatal(response, f"Compose exception: {e}")
+                return response
 
-        requested = []
-        for name, required in composite.requireds:
-            if required.apiVersion and required.kind:
-                r = Map(apiVersion=required.apiVersion, kind=required.kind)
-                if required.namespace:
-                    r.namespace = required.namespace
-                if required.matchName:
-                    r.matchName = required.matchName
-                for key, value in required.matchLabels:
-                    r.matchLabels[key] = value
-                if r != composite.context._requireds[name]:
-                    composite.context._requireds[name] = r
-                    requested.append(name)
+        with tracing.span('requireds'):
+            requested = self.requestRequireds(request, response)
         if requested:
             logger.info(f"Requireds requested: {','.join(requested)}")
             return response
 
-        unknownResources = []
-        warningResources = []
-        fatalResources = []
-        for name, resource in sorted(entry for entry in composite.resources):
-            unknowns = resource.desired._getUnknowns
-            if unknowns:
-                unknownResources.append(name)
-                warning = False
-                fatal = False
-                if resource.observed:
-                    warningResources.append(name)
-                    warning = True
-                    if resource.unknownsFatal or (resource.unknownsFatal is None and composite.unknownsFatal):
-                        fatalResources.append(name)
-                        fatal = True
-                if self.debug:
-                    for destination, source in sorted(unknowns.items()):
-                        destination = self.trimFullName(destination)
-                        source = self.trimFullName(source)
-                        if fatal:
-                            logger.error(f'Observed unknown: {destination} = {source}')
-                        elif warning:
-                            logger.warning(f'Observed unknown: {destination} = {source}')
-                        else:
-                            logger.debug(f'Desired unknown: {destination} = {source}')
-                if resource.observed:
-                    resource.desired._patchUnknowns(resource.observed)
-                else:
-                    del composite.resources[name]
+        with tracing.span('unknowns'):
+            unknownResources = []
+            warningResources = []
+            fatalResources = []
+            for name, resource in sorted(entry for entry in composite.resources):
+                unknowns = resource.desired._getUnknowns
+                if unknowns:
+                    unknownResources.append(name)
+                    warning = False
+                    unknownsFatal = False
+                    if resource.observed:
+                        warningResources.append(name)
+                        warning = True
+                        if resource.unknownsFatal or (resource.unknownsFatal is None and composite.unknownsFatal):
+                            fatalResources.append(name)
+                            unknownsFatal = True
+                    if self.debug:
+                        for destination, source in sorted(unknowns.items()):
+                            destination = self.trimFullName(destination)
+                            source = self.trimFullName(source)
+                            if unknownsFatal:
+                                logger.error(f'Observed unknown: {destination} = {source}')
+                            elif warning:
+                                logger.warning(f'Observed unknown: {destination} = {source}')
+                            else:
+                                logger.debug(f'Desired unknown: {destination} = {source}')
+                    if resource.observed:
+                        resource.desired._patchUnknowns(resource.observed)
+                    else:
+                        del composite.resources[name]
 
         if fatalResources:
             level = logger.error
@@ -209,15 +321,133 @@ class FunctionRunner(grpcv1.FunctionRunnerService):
         if event:
             event(reason, message)
 
-        for name, resource in composite.resources:
-            if resource.autoReady or (resource.autoReady is None and composite.autoReady):
-                if resource.ready is None:
-                    if resource.conditions.Ready.status:
-                        resource.ready = True
+        with tracing.span('auto-ready'):
+            for name, resource in composite.resources:
+                if resource.autoReady or (resource.autoReady is None and composite.autoReady):
+                    if resource.ready is None:
+                        if resource.conditions.Ready.status:
+                            resource.ready = True
 
         logger.info('Completed compose')
         return response
 
+    def get_clazz(self, composite, logger):
+        """Return the cached composite class, importing or executing it on first use.
+
+        Returns a (clazz, None) tuple, or (None, error) if the class could not be loaded.
+        """
+        clazz = self.clazzes.get(composite)
+        if clazz:
+            self.hits[composite] += 1
+            return clazz, None
+        key = composite
+        if '\n' in composite:
+            module = Module()
+            try:
+                exec(bytecode.compile(composite, scriptName(composite)), module.__dict__)
+            except Exception as e:
+                logger.exception('Exec exception')
+                return None, f"Exec exception: {e}"
+            composite = ['<script>', 'Composite']
+        else:
+            composite = composite.rsplit('.', 1)
+            if len(composite) == 1:
+                logger.error(f"Composite class name does not include module: {composite[0]}")
+                return None, f"Composite class name does not include module: {composite[0]}"
+            modules = set(sys.modules)
+            try:
+                module = importlib.import_module(composite[0])
+                self.modules.update(set(sys.modules) - modules)
+            except Exception as e:
+                logger.error(str(e))
+                return None, f"Import module exception: {e}"
+        clazz = getattr(module, composite[1], None)
+        if not clazz:
+            logger.error(f"{composite[0]} did not define: {composite[1]}")
+            return None, f"{composite[0]} did not define: {composite[1]}"
+        composite = '.'.join(composite)
+        if not inspect.isclass(clazz):
+            logger.error(f"{composite} is not a class")
+            return None, f"{composite} is not a class"
+        if not issubclass(clazz, BaseComposite):
+            logger.error(f"{composite} is not a subclass of BaseComposite")
+            return None, f"{composite} is not a subclass of BaseComposite"
+        self.clazzes[key] = clazz
+        self.hits[key] = 1
+        self.names[key] = className(key, clazz)
+        return clazz, None
+
+    async def warm_up(self, composites, compose=False):
+        """Load composite classes ahead of the first request, optionally composing a synthetic XR.
+
+        Each composite is either a complete class path or the path to an inline script file.
+        Returns the number of composite classes which loaded.
+        """
+        loaded = 0
+        for composite in composites:
+            path = pathlib.Path(composite).expanduser()
+            if path.is_file():
+                composite = path.read_text()
+            clazz, error = self.get_clazz(composite, logger)
+            if not clazz:
+                logger.warning(f"Warm-up failed: {error}")
+                continue
+            loaded += 1
+            if compose:
+                request = fnv1.RunFunctionRequest()
+                request.observed.composite.resource.update({
+                    'apiVersion': 'warmup.pythonic.fortra.com/v1alpha1',
+                    'kind': clazz.__name__,
+                    'metadata': {
+                        'name': 'warm-up',
+                    },
+                })
+                request.input['composite'] = composite
+                try:
+                    await self.run_function(request)
+                except Exception:
+                    logger.debug('Warm-up compose exception', exc_info=True)
+        return loaded
+
+    def declareRequireds(self, clazz, request, response):
+        requireds = clazz.requiredResources
+        if callable(requireds):
+            observed = protobuf.Message(None, 'request', request.DESCRIPTOR, request, 'Function Request')
+            requireds = requireds(observed.observed.composite.resource)
+        if not requireds:
+            return
+        for name, required in requireds.items():
+            selector = response.requirements.extra_resources[name]
+            selector.Clear()
+            selector.api_version = required['apiVersion']
+            selector.kind = required['kind']
+            if 'namespace' in required and required['namespace']:
+                selector.namespace = required['namespace']
+            if 'name' in required and required['name']:
+                selector.match_name = required['name']
+            if 'labels' in required and required['labels']:
+                labels = required['labels']
+                for entry in labels:
+                    if isinstance(entry, str):
+                        selector.match_labels.labels[entry] = str(labels[entry])
+                    elif isinstance(entry, (list, tuple)):
+                        selector.match_labels.labels[entry[0]] = str(entry[1])
+
+    def requestRequireds(self, request, response):
+        requested = []
+        requireds = request.context.fields.get('_requireds')
+        for name, selector in sorted(response.requirements.extra_resources.items()):
+            if selector.api_version and selector.kind:
+                value = selectorValue(selector)
+                if requireds is not None:
+                    if requireds.struct_value.fields.get(name) == value:
+                        continue
+                else:
+                    requireds = request.context.fields['_requireds']
+                requireds.struct_value.fields[name].CopyFrom(value)
+                requested.append(name)
+        return requested
+
     def trimFullName(self, name):
         name = name.split('.')
         for values in (
@@ -247,6 +477,139 @@ class FunctionRunner(grpcv1.FunctionRunnerService):
         return '.'.join(name)
 
 
+class Response:
+    """A RunFunctionResponse whose desired state and context are still owned by the request.
+
+    The request is never used again once composed, so rather than copying its desired
+    state and context into the response they are spliced into the serialized response.
+    """
+
+    def __init__(self, request, response):
+        self.request = request
+        self.response = response
+
+    def SerializeToString(self):
+        desired = self.request.desired.SerializeToString()
+        context = self.request.context.SerializeToString()
+        return b''.join((
+            self.response.SerializeToString(),
+            _DESIRED_TAG, varint(len(desired)), desired,
+            _CONTEXT_TAG, varint(len(context)), context,
+        ))
+
+    def message(self):
+        """Return a standalone RunFunctionResponse, copying the desired state and context.
+
+        These are merged into the response as parsing SerializeToString would merge them.
+        """
+        response = fnv1.RunFunctionResponse()
+        response.CopyFrom(self.response)
+        response.desired.MergeFrom(self.request.desired)
+        response.desired.SetInParent()
+        response.context.MergeFrom(self.request.context)
+        response.context.SetInParent()
+        return response
+
+
+def received(data):
+    """gRPC request deserializer keeping the received bytes, see Received."""
+    return fnv1.RunFunctionRequest.FromString(data), data
+
+
+class Received:
+    """The desired state and context of a request as received, parsed only if a composite reads them.
+
+    Requests are composed in place, see Response. Without the received request bytes, the
+    desired state and context are serialized before composing.
+    """
+
+    def __init__(self, request, data=None):
+        if data is None:
+            desired = request.desired.SerializeToString()
+            context = request.context.SerializeToString()
+            data = b''.join((
+                _REQUEST_DESIRED_TAG, varint(len(desired)), desired,
+                _REQUEST_CONTEXT_TAG, varint(len(context)), context,
+            ))
+        self.data = data
+        self.request = None
+
+    def message(self):
+        if self.request is None:
+            self.request = fnv1.RunFunctionRequest.FromString(self.data)
+            self.data = None
+        return self.request
+
+
+class RequestMessage(protobuf.Message):
+    """The read only request of a composite, whose desired state and context are as received."""
+
+    def __init__(self, request, received):
+        super().__init__(None, 'request', request.DESCRIPTOR, request, 'Function Request')
+        self.__dict__['_received'] = received
+
+    def __getitem__(self, key):
+        if key in ('desired', 'context') and key not in self._cache:
+            received = protobuf.Message(None, self._key, self._descriptor, self._received.message(), self._readOnly)
+            self._cache[key] = received[key]
+        return super().__getitem__(key)
+
+
+def responseMessage(request, response):
+    message = protobuf.Message(None, 'response', response.DESCRIPTOR, response)
+    message._cache['desired'] = protobuf.Message(message, 'desired', request.desired.DESCRIPTOR, request.desired)
+    message._cache['context'] = protobuf.Values(message, 'context', request.context, protobuf.Values.Type.MAP)
+    return message
+
+
+SERVICE_NAME = 'apiextensions.fn.proto.v1.FunctionRunnerService'
+DEFAULT_TTL = 60
+_DESIRED_TAG = bytes(((fnv1.RunFunctionResponse.DESIRED_FIELD_NUMBER << 3) | 2,))
+_CONTEXT_TAG = bytes(((fnv1.RunFunctionResponse.CONTEXT_FIELD_NUMBER << 3) | 2,))
+_REQUEST_DESIRED_TAG = bytes(((fnv1.RunFunctionRequest.DESIRED_FIELD_NUMBER << 3) | 2,))
+_REQUEST_CONTEXT_TAG = bytes(((fnv1.RunFunctionRequest.CONTEXT_FIELD_NUMBER << 3) | 2,))
+
+
+def varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def fatal(response, message):
+    # Avoids importing crossplane.function.response, which pulls in pydantic
+    response.results.append(fnv1.Result(severity=fnv1.SEVERITY_FATAL, message=message))
+
+
+def selectorValue(selector):
+    # The context._requireds entry for a selector, compared as a message rather than through Maps
+    selected = {'apiVersion': selector.api_version, 'kind': selector.kind}
+    if selector.namespace:
+        selected['namespace'] = selector.namespace
+    if selector.match_name:
+        selected['matchName'] = selector.match_name
+    if selector.match_labels.labels:
+        selected['matchLabels'] = dict(selector.match_labels.labels)
+    value = struct_pb2.Value()
+    value.struct_value.update(selected)
+    return value
+
+
+def className(composite, clazz):
+    """The class path, or for inline scripts a digest of the script so each script is named apart."""
+    if '\n' in composite:
+        return f"{scriptName(composite)}.{clazz.__name__}"
+    return composite
+
+
+def scriptName(script):
+    """The filename inline scripts are compiled with, as shown in tracebacks and allocation traces."""
+    return f"<script {hashlib.sha256(script.encode('utf-8')).hexdigest()[:12]}>"
+
+
 def ordinal(ix):
     ix = int(ix)
     if 11 <= (ix % 100) <= 13:
@@ -0,0 +1,141 @@
+"""An in memory importer of function-pythonic package modules."""
+
+import hashlib
+import importlib.abc
+import importlib.util
+import sys
+
+from . import bytecode
+
+
+ORIGIN = '<packages>'
+
+
+class PackageImporter(importlib.abc.MetaPathFinder, importlib.abc.InspectLoader):
+    """Imports modules from package files held in memory.
+
+    Files are keyed by their package path tuple, for example ('example', 'composite.py').
+    Changes are made to a staging copy which is made visible by publish().
+    Directories without an __init__.py are imported as empty packages.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.files = {}
+        self.directories = set()
+        self.staging = None
+        self.codes = {}
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    # Package storage, see packages.py
+
+    def staged(self):
+        if self.staging is None:
+            self.staging = dict(self.files)
+        return self.staging
+
+    def write(self, package, name, data):
+        """Stage the file if its content changed, returning if it was staged."""
+        key = (*package, *name.split('/'))
+        digest = hashlib.sha256(data).hexdigest()
+        current = (self.staging if self.staging is not None else self.files).get(key)
+        if current is not None and current[1] == digest:
+            return False
+        self.staged()[key] = (data, digest)
+        return True
+
+    def remove(self, package, name):
+        self.staged().pop((*package, *name.split('/')), None)
+
+    def unseen(self):
+        # Nothing survives a restart
+        return []
+
+    def empty(self, package):
+        package = tuple(package)
+        return not any(key[:len(package)] == package for key in self.staged())
+
+    def remove_package(self, package):
+        pass
+
+    def publish(self):
+        if self.staging is None:
+            return False
+        self.files = self.staging
+        self.staging = None
+        self.directories = {key[:ix] for key in self.files for ix in range(1, len(key))}
+        live = {(key, digest) for key, (_, digest) in self.files.items()}
+        self.codes = {entry: code for entry, code in self.codes.items() if entry in live}
+        self.generation += 1
+        return True
+
+    def owns(self, module):
+        return getattr(getattr(module, '__spec__', None), 'loader', None) is self
+
+    def rebase(self, module):
+        # Modules are found by name, not by generation
+        pass
+
+    # Importer
+
+    def find_spec(self, fullname, path=None, target=None):
+        key = self.find(fullname)
+        if key is None:
+            return None
+        spec = importlib.util.spec_from_loader(
+            fullname,
+            self,
+            origin=f"{ORIGIN}/{'/'.join(key)}",
+            is_package=key[-1] == '__init__.py' or key == tuple(fullname.split('.')),
+        )
+        spec.has_location = key in self.files
+        return spec
+
+    def find(self, fullname):
+        parts = tuple(fullname.split('.'))
+        key = (*parts, '__init__.py')
+        if key in self.files:
+            return key
+        key = (*parts[:-1], f"{parts[-1]}.py")
+        if key in self.files:
+            return key
+        if parts in self.directories:
+            return parts
+        return None
+
+    def exec_module(self, module):
+        code = self.get_code(module.__spec__.name)
+        exec(code, module.__dict__)
+
+    def get_code(self, fullname):
+        key = self.find(fullname)
+        if key is None:
+            raise ImportError(f"No package module named {fullname}", name=fullname)
+        if key not in self.files:
+            return compile('', f"{ORIGIN}/{'/'.join(key)}", 'exec')
+        data, digest = self.files[key]
+        code = self.codes.get((key, digest))
+        if code is None:
+            code = self.codes[(key, digest)] = bytecode.compile(data, f"{ORIGIN}/{'/'.join(key)}")
+        return code
+
+    def get_source(self, fullname):
+        key = self.find(fullname)
+        if key is None:
+            raise ImportError(f"No package module named {fullname}", name=fullname)
+        if key not in self.files:
+            return ''
+        return importlib.util.decode_source(self.files[key][0])
+
+    def is_package(self, fullname):
+        key = self.find(fullname)
+        if key is None:
+            raise ImportError(f"No package module named {fullname}", name=fullname)
+        return key[-1] == '__init__.py' or key not in self.files
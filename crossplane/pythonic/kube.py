@@ -0,0 +1,377 @@
+"""A minimal Kubernetes API client used to discover function-pythonic packages."""
+
+import asyncio
+import base64
+import functools
+import json
+import logging
+import os
+import pathlib
+import ssl
+import tempfile
+import urllib.parse
+
+import aiohttp
+import yaml
+
+
+SERVICE_ACCOUNT_DIR = pathlib.Path('/var/run/secrets/kubernetes.io/serviceaccount')
+# Request failures which are retried with backoff, such as a briefly unavailable API server
+TRANSIENT = (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError)
+
+logger = logging.getLogger(__name__)
+
+
+class Client:
+    """Kubernetes API requests using the headers and auth, reloaded by login when authenticating."""
+
+    def __init__(self, server, context=None, headers=None, auth=None, login=None):
+        self.server = server.rstrip('/')
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(ssl=context if context is not None else False),
+        )
+        self.headers = headers or {}
+        self.auth = auth
+        self.login = login
+
+    async def authenticate(self):
+        """Load the credentials again, such as a rotated service account token."""
+        if self.login is not None:
+            self.headers, self.auth = await asyncio.to_thread(self.login)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        await self.session.close()
+
+    def path(self, resource, namespace=None):
+        if namespace:
+            return f"/api/v1/namespaces/{namespace}/{resource}"
+        return f"/api/v1/{resource}"
+
+    async def list(self, resource, namespace=None, labelSelector=None):
+        """List the core/v1 resources, returning the items and the list resourceVersion."""
+        params = {}
+        if labelSelector:
+            params['labelSelector'] = labelSelector
+        url = f"{self.server}{self.path(resource, namespace)}"
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        async with self.session.get(url, headers=self.headers, auth=self.auth) as response:
+            checkStatus(response)
+            body = await response.json()
+        kind = body.get('kind', 'List')
+        kind = kind[:-4] if kind.endswith('List') else kind
+        items = body.get('items', [])
+        for item in items:
+            item.setdefault('apiVersion', 'v1')
+            item.setdefault('kind', kind)
+        return items, body.get('metadata', {}).get('resourceVersion')
+
+    async def watch(self, resource, namespace=None, labelSelector=None, resourceVersion=None, timeoutSeconds=300):
+        """Watch the core/v1 resources, yielding each event until the server ends the watch."""
+        params = {
+            'watch': 'true',
+            'allowWatchBookmarks': 'true',
+            'timeoutSeconds': str(timeoutSeconds),
+        }
+        if labelSelector:
+            params['labelSelector'] = labelSelector
+        if resourceVersion:
+            params['resourceVersion'] = resourceVersion
+        url = f"{self.server}{self.path(resource, namespace)}?{urllib.parse.urlencode(params)}"
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=timeoutSeconds + 30)
+        async with self.session.get(url, headers=self.headers, auth=self.auth, timeout=timeout) as response:
+            if response.status == 410:
+                raise Expired(resourceVersion)
+            checkStatus(response)
+            # Events are json lines, which may be larger than the stream reader line limit
+            buffer = b''
+            async for chunk in response.content.iter_any():
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def checkStatus(response):
+    if response.status in (401, 403):
+        raise Unauthorized(f"{response.status} {response.reason}")
+    response.raise_for_status()
+
+
+class Expired(Exception):
+    """The watch resourceVersion is too old, the resources must be listed again."""
+
+
+class Unauthorized(Exception):
+    """The credentials were rejected, they are loaded again before retrying."""
+
+
+class Unsupported(Exception):
+    """The kubeconfig user authenticates using an exec or auth-provider plugin, see connected()."""
+
+
+class Watcher:
+    """Lists and then watches resources, calling created, updated, and deleted for their changes.
+
+    Watches resume from the last seen resourceVersion, advanced by bookmarks. An expired
+    resourceVersion lists the resources again, reconciled against the known resources.
+    Failures are retried with exponential backoff, loading the client credentials again
+    before each list or watch, as service account tokens rotate.
+    """
+
+    def __init__(
+        self,
+        client,
+        resource,
+        namespace,
+        labelSelector,
+        created,
+        updated,
+        deleted,
+        items=None,
+        resourceVersion=None,
+        timeoutSeconds=300,
+        backoff=1.0,
+        maxBackoff=60.0,
+    ):
+        self.client = client
+        self.resource = resource
+        self.namespace = namespace
+        self.labelSelector = labelSelector
+        self.created = created
+        self.updated = updated
+        self.deleted = deleted
+        self.resources = {resourceKey(item): item for item in items or []}
+        self.resourceVersion = resourceVersion if items is not None else None
+        self.timeoutSeconds = timeoutSeconds
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+
+    def __str__(self):
+        if self.namespace:
+            return f"{self.namespace}/{self.resource}"
+        return self.resource
+
+    async def run(self):
+        delay = self.backoff
+        while True:
+            try:
+                await self.client.authenticate()
+                if self.resourceVersion is None:
+                    await self.relist()
+                async for event in self.client.watch(
+                    self.resource,
+                    self.namespace,
+                    self.labelSelector,
+                    self.resourceVersion,
+                    self.timeoutSeconds,
+                ):
+                    await self.event(event)
+                    delay = self.backoff
+            except Expired:
+                logger.info(f"Watch of {self} expired at resourceVersion {self.resourceVersion}, listing again")
+                self.resourceVersion = None
+            except Unauthorized as e:
+                logger.warning(f"Watch of {self} unauthorized, authenticating again in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.maxBackoff)
+            except TRANSIENT as e:
+                logger.warning(f"Watch of {self} failed, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.maxBackoff)
+
+    async def relist(self):
+        items, resourceVersion = await self.client.list(self.resource, self.namespace, self.labelSelector)
+        resources = {}
+        for item in items:
+            key = resourceKey(item)
+            resources[key] = item
+            await self.change(self.resources.get(key), item)
+        for key, old in self.resources.items():
+            if key not in resources:
+                await self.change(old, None)
+        self.resources = resources
+        self.resourceVersion = resourceVersion
+
+    async def event(self, event):
+        kind = event.get('type')
+        body = event.get('object') or {}
+        if kind == 'ERROR':
+            if body.get('code') == 410:
+                raise Expired(self.resourceVersion)
+            raise ValueError(f"Watch error: {body.get('message', body)}")
+        if kind in ('ADDED', 'MODIFIED'):
+            key = resourceKey(body)
+            await self.change(self.resources.get(key), body)
+            self.resources[key] = body
+        elif kind == 'DELETED':
+            await self.change(self.resources.pop(resourceKey(body), body), None)
+        self.resourceVersion = body.get('metadata', {}).get('resourceVersion', self.resourceVersion)
+
+    async def change(self, old, body):
+        # A failed handler must not stop the watch of the other resources
+        try:
+            if old is None:
+                await self.created(body)
+            elif body is None:
+                await self.deleted(old)
+            elif resourceVersion(old) != resourceVersion(body):
+                await self.updated(body, old)
+        except Exception:
+            logger.exception(f"Handler of {self} {resourceKey(body or old)} failed")
+
+
+def resourceKey(body):
+    metadata = body.get('metadata', {})
+    return f"{metadata.get('namespace')}/{metadata.get('name')}"
+
+
+def resourceVersion(body):
+    return body.get('metadata', {}).get('resourceVersion')
+
+
+def client():
+    """Create a Client using the in cluster service account or the current kubeconfig context."""
+    host = os.getenv('KUBERNETES_SERVICE_HOST')
+    if host and (SERVICE_ACCOUNT_DIR / 'token').is_file():
+        if ':' in host:
+            host = f"[{host}]"
+        context = ssl.create_default_context(cafile=str(SERVICE_ACCOUNT_DIR / 'ca.crt'))
+        login = functools.partial(tokenCredentials, SERVICE_ACCOUNT_DIR / 'token')
+        return Client(
+            f"https://{host}:{os.getenv('KUBERNETES_SERVICE_PORT', '443')}",
+            context,
+            *login(),
+            login,
+        )
+
+    path = os.getenv('KUBECONFIG', '~/.kube/config').split(os.pathsep)[0]
+    path = pathlib.Path(path).expanduser()
+    context, cluster, user = kubeconfig(path)
+    login = functools.partial(kubeconfigCredentials, path)
+    server = cluster['server']
+    if not server.startswith('https:'):
+        return Client(server, None, *credentials(user), login)
+
+    context = ssl.create_default_context(
+        cafile=configPath(path, cluster.get('certificate-authority')),
+        cadata=configData(cluster.get('certificate-authority-data')),
+    )
+    if cluster.get('insecure-skip-tls-verify'):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    loadCertificate(
+        context,
+        configPath(path, user.get('client-certificate')),
+        configBytes(user.get('client-certificate-data')),
+        configPath(path, user.get('client-key')),
+        configBytes(user.get('client-key-data')),
+    )
+    return Client(server, context, *credentials(user), login)
+
+
+def kubeconfig(path):
+    """Return the current context, cluster, and user of the kubeconfig file."""
+    config = yaml.safe_load(path.read_text())
+    current = config.get('current-context')
+    context = named(config.get('contexts'), current, 'context')
+    cluster = named(config.get('clusters'), context.get('cluster'), 'cluster')
+    user = named(config.get('users'), context.get('user'), 'user')
+    if user.get('exec') or user.get('auth-provider'):
+        raise Unsupported(f"kubeconfig user {context.get('user')} uses an exec or auth-provider plugin")
+    return context, cluster, user
+
+
+def kubeconfigCredentials(path):
+    return credentials(kubeconfig(path)[2])
+
+
+def tokenCredentials(path):
+    return {'Authorization': f"Bearer {pathlib.Path(path).read_text().strip()}"}, None
+
+
+def credentials(user):
+    """Return the request headers and auth of a kubeconfig user."""
+    if user.get('token'):
+        return {'Authorization': f"Bearer {user['token']}"}, None
+    if user.get('username') and user.get('password'):
+        return {}, aiohttp.BasicAuth(user['username'], user['password'])
+    return {}, None
+
+
+def connected(info):
+    """Create a Client from a kopf ConnectionInfo, kopf's logins support credential plugins."""
+    headers = {}
+    auth = None
+    if info.token:
+        headers['Authorization'] = f"{info.scheme or 'Bearer'} {info.token}"
+    elif info.username and info.password:
+        auth = aiohttp.BasicAuth(info.username, info.password)
+    if not info.server.startswith('https:'):
+        return Client(info.server, None, headers, auth)
+    context = ssl.create_default_context(
+        cafile=info.ca_path,
+        cadata=info.ca_data.decode('utf-8') if info.ca_data else None,
+    )
+    if info.insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    loadCertificate(context, info.certificate_path, info.certificate_data, info.private_key_path, info.private_key_data)
+    return Client(info.server, context, headers, auth)
+
+
+def named(entries, name, key):
+    for entry in entries or []:
+        if entry.get('name') == name:
+            return entry.get(key) or {}
+    return {}
+
+
+def configPath(config, path):
+    if path:
+        return str((config.parent / path).expanduser())
+    return None
+
+
+def configData(data):
+    if data:
+        return base64.b64decode(data).decode('utf-8')
+    return None
+
+
+def configBytes(data):
+    if data:
+        return base64.b64decode(data)
+    return None
+
+
+def loadCertificate(context, certificate, certificateData, key, keyData):
+    """Load the client certificate and key paths or data into the ssl context.
+
+    ssl only loads them from files, data is written to temporary files removed once loaded.
+    """
+    temporary = []
+    try:
+        if not certificate and certificateData:
+            certificate = temporaryFile(certificateData, temporary)
+        if not key and keyData:
+            key = temporaryFile(keyData, temporary)
+        if certificate and key:
+            context.load_cert_chain(certificate, key)
+    finally:
+        for name in temporary:
+            os.unlink(name)
+
+
+def temporaryFile(data, temporary):
+    with tempfile.NamedTemporaryFile('wb', prefix='function-pythonic-', delete=False) as file:
+        temporary.append(file.name)
+        file.write(data)
+    return file.name
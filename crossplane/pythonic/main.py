@@ -2,27 +2,66 @@
 
 import argparse
 import asyncio
+import datetime
+import hashlib
+import json
 import logging
+import logging.handlers
 import os
 import pathlib
+import queue
 import shlex
+import shutil
 import signal
+import site
+import subprocess
 import sys
-import traceback
+import time
 
-import crossplane.function.logging
-import crossplane.function.proto.v1.run_function_pb2_grpc as grpcv1
 import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 
-from . import function
+from . import bytecode, function, memory, profiling, tracing
 
 
 def main():
+    if sys.argv[1:2] == ['render']:
+        from . import render
+        sys.exit(render.main(sys.argv[2:]))
+    if sys.argv[1:2] == ['replay']:
+        from . import replay
+        sys.exit(replay.main(sys.argv[2:]))
     asyncio.run(Main().main())
 
 
 class Main:
+    def __init__(self):
+        self.started = time.monotonic()
+
     async def main(self):
+        args = self.parse_args()
+        if args.import_times:
+            times = import_times(['crossplane.pythonic.main', 'crossplane.pythonic.function'])
+            for name, (self_us, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][1])[:40]:
+                print(f"{cumulative_us / 1000:9.3f}ms {self_us / 1000:9.3f}ms {name}")
+            sys.exit(0)
+        if not args.tls_certs_dir and not args.insecure:
+            print('Either --tls-certs-dir or --insecure must be specified', file=sys.stderr)
+            sys.exit(1)
+
+        self.configure_logging(args)
+        # enables read only volumes or mismatched uid volumes
+        sys.dont_write_bytecode = True
+        if args.bytecode_cache_dir:
+            bytecode.install(args.bytecode_cache_dir)
+        tracing.configure(args.trace_file)
+        try:
+            await self.run(args)
+        finally:
+            tracing.configure(None)
+            self.log_listener.stop()
+
+    def parse_args(self, argv=None):
         parser = argparse.ArgumentParser('Crossplane Function Pythonic')
         parser.add_argument(
             '--debug', '-d',
@@ -36,6 +75,12 @@ class Main:
             metavar='WIDTH',
             help='Width of the logger name in the log output, default 40',
         )
+        parser.add_argument(
+            '--log-format',
+            choices=('text', 'json'),
+            default='text',
+            help='Log output format, json emits one object per line including the XR and class, default text',
+        )
         parser.add_argument(
             '--address',
             default='0.0.0.0:9443',
@@ -75,11 +120,34 @@ class Main:
             metavar='DIRECTORY',
             help='Directory to store discovered function-pythonic ConfigMaps to, defaults "<cwd>/pythonic-packages"'
         )
+        parser.add_argument(
+            '--packages-in-memory',
+            action='store_true',
+            help='Import discovered packages from memory instead of writing them to --packages-dir.',
+        )
+        parser.add_argument(
+            '--packages-watcher',
+            choices=['kopf', 'builtin'],
+            default='kopf',
+            help='Watch packages using the kopf framework or the lightweight builtin watcher, default kopf.',
+        )
+        parser.add_argument(
+            '--packages-debounce',
+            type=float,
+            default=0.5,
+            metavar='SECONDS',
+            help='Seconds to coalesce package changes into one module invalidation, default 0.5',
+        )
         parser.add_argument(
             '--pip-install',
             metavar='COMMAND',
             help='Pip install command to install additional Python packages.'
         )
+        parser.add_argument(
+            '--pip-cache-dir',
+            metavar='DIRECTORY',
+            help='Persistent directory to cache --pip-install wheels and installed environments in.'
+        )
         parser.add_argument(
             '--python-path',
             action='append',
@@ -87,26 +155,153 @@ class Main:
             metavar='DIRECTORY',
             help='Filing system directories to add to the python path',
         )
+        parser.add_argument(
+            '--python-path-reload',
+            action='store_true',
+            help='Reload changed modules in the --python-path directories.',
+        )
+        parser.add_argument(
+            '--python-path-poll',
+            type=float,
+            metavar='SECONDS',
+            help='Poll the --python-path directories for changes instead of using inotify.',
+        )
+        parser.add_argument(
+            '--bytecode-cache-dir',
+            metavar='DIRECTORY',
+            help='Writable directory to cache compiled python modules and inline scripts in.',
+        )
+        parser.add_argument(
+            '--warm-up',
+            action='append',
+            default=[],
+            metavar='COMPOSITE',
+            help='Composite class path or inline script file to load before serving requests',
+        )
+        parser.add_argument(
+            '--warm-up-compose',
+            action='store_true',
+            help='Also run each --warm-up Composite against a synthetic request.',
+        )
+        parser.add_argument(
+            '--import-times',
+            action='store_true',
+            help='Print the slowest module imports of function-pythonic startup and exit.',
+        )
+        parser.add_argument(
+            '--trace-file',
+            metavar='PATH',
+            help='Export RunFunction phase spans as OTLP json lines to the file, "-" for stdout.',
+        )
+        parser.add_argument(
+            '--admin',
+            action='store_true',
+            help='Serve the admin HTTP endpoint showing classes, packages, and requests.',
+        )
+        parser.add_argument(
+            '--admin-address',
+            default='127.0.0.1:9080',
+            metavar='ADDRESS',
+            help='Address for the --admin endpoint, default: 127.0.0.1:9080',
+        )
+        parser.add_argument(
+            '--admin-token-file',
+            metavar='PATH',
+            help='File containing a token required by --admin POST requests, and to bind a non loopback --admin-address.',
+        )
+        parser.add_argument(
+            '--slow-seconds',
+            type=float,
+            default=1.0,
+            metavar='SECONDS',
+            help='RunFunction duration recorded as a slow request for the --admin endpoint, default 1',
+        )
+        parser.add_argument(
+            '--profile-dir',
+            metavar='DIRECTORY',
+            help='Directory to write compose cProfile pstats files to, SIGUSR1 toggles profiling.',
+        )
+        parser.add_argument(
+            '--profile-threshold',
+            type=float,
+            metavar='SECONDS',
+            help='Profile the next compose of an XR whose compose took longer than SECONDS.',
+        )
+        parser.add_argument(
+            '--profile-sample',
+            type=float,
+            default=0.0,
+            metavar='FRACTION',
+            help='Fraction of composes to profile, default 0',
+        )
+        parser.add_argument(
+            '--profile-filter',
+            metavar='REGEX',
+            help='Profile composes whose XR or class matches the regular expression.',
+        )
+        parser.add_argument(
+            '--memory-profile',
+            action='store_true',
+            help='Trace memory allocations with tracemalloc, accounting compose memory per composite class.',
+        )
+        parser.add_argument(
+            '--memory-interval',
+            type=float,
+            default=300,
+            metavar='SECONDS',
+            help='Interval to log the --memory-profile report, default 300',
+        )
+        parser.add_argument(
+            '--memory-top',
+            type=int,
+            default=10,
+            metavar='COUNT',
+            help='Number of top allocation sites in the --memory-profile report, default 10',
+        )
+        parser.add_argument(
+            '--capture-dir',
+            metavar='DIRECTORY',
+            help='Capture sampled requests and responses, with credentials redacted, for replay.',
+        )
+        parser.add_argument(
+            '--capture-sample',
+            type=float,
+            default=0.01,
+            metavar='FRACTION',
+            help='Fraction of requests to --capture-dir, default 0.01',
+        )
+        parser.add_argument(
+            '--capture-file-size',
+            type=int,
+            default=64,
+            metavar='MIB',
+            help='Uncompressed MiB of requests per capture file, default 64',
+        )
+        parser.add_argument(
+            '--capture-files',
+            type=int,
+            default=10,
+            metavar='COUNT',
+            help='Number of capture files to keep, default 10',
+        )
         parser.add_argument(
             '--allow-oversize-protos',
             action='store_true',
             help='Allow oversized protobuf messages'
         )
-        args = parser.parse_args()
-        if not args.tls_certs_dir and not args.insecure:
-            print('Either --tls-certs-dir or --insecure must be specified', file=sys.stderr)
-            sys.exit(1)
-
-        self.configure_logging(args)
-        # enables read only volumes or mismatched uid volumes
-        sys.dont_write_bytecode = True
-        await self.run(args)
+        return parser.parse_args(argv)
 
     # Allow for independent running of function-pythonic
     async def run(self, args):
         if args.pip_install:
-            import pip._internal.cli.main
-            pip._internal.cli.main.main(['install', '--user', *shlex.split(args.pip_install)])
+            start = time.monotonic()
+            if args.pip_cache_dir:
+                action = pip_install_cached(shlex.split(args.pip_install), args.pip_cache_dir)
+            else:
+                import pip._internal.cli.main
+                pip._internal.cli.main.main(['install', '--user', *shlex.split(args.pip_install)])
+                action = 'Installed'
+            logging.getLogger(__name__).info(f"Pip install: {action} in {time.monotonic() - start:.3f}s")
 
         for path in reversed(args.python_path):
             sys.path.insert(0, str(pathlib.Path(path).expanduser().resolve()))
@@ -118,8 +313,33 @@ class Main:
 
         grpc.aio.init_grpc_aio()
         grpc_runner = function.FunctionRunner(args.debug)
+        grpc_runner.profiler = profiling.Profiler(
+            args.profile_dir,
+            args.profile_threshold,
+            args.profile_sample,
+            args.profile_filter,
+        )
+        grpc_runner.memory = memory.MemoryProfiler(args.memory_profile, args.memory_top)
+        grpc_runner.slowSeconds = args.slow_seconds
+        if args.capture_dir:
+            from . import capture
+            grpc_runner.capture = capture.Capture(
+                args.capture_dir,
+                args.capture_sample,
+                args.capture_file_size * 1024 * 1024,
+                args.capture_files,
+            )
+        if args.profile_dir:
+            def toggle_profiling():
+                grpc_runner.profiler.enabled = not grpc_runner.profiler.enabled
+                logging.getLogger(__name__).info(f"Profiling {'enabled' if grpc_runner.profiler.enabled else 'disabled'}")
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiling)
         grpc_server = grpc.aio.server()
-        grpcv1.add_FunctionRunnerServiceServicer_to_server(grpc_runner, grpc_server)
+        grpc_runner.add_to_server(grpc_server)
+        self.grpc_server = grpc_server
+        self.health = health.aio.HealthServicer()
+        health_pb2_grpc.add_HealthServicer_to_server(self.health, grpc_server)
+        await self.set_serving(False)
         if args.insecure:
             grpc_server.add_insecure_port(args.address)
         else:
@@ -136,35 +356,233 @@ class Main:
                 ),
             )
         await grpc_server.start()
+        if args.admin:
+            from . import admin
+            token = pathlib.Path(args.admin_token_file).expanduser().read_text().strip() if args.admin_token_file else None
+            admin_server = await admin.Admin(grpc_runner, token).start(args.admin_address)
 
-        if args.packages:
-            from . import packages
-            async with asyncio.TaskGroup() as tasks:
-                tasks.create_task(grpc_server.wait_for_termination())
-                tasks.create_task(packages.operator(
-                    grpc_server,
+        # The health service reports NOT_SERVING until packages are synced and warmed up
+        async with asyncio.TaskGroup() as tasks:
+            tasks.create_task(grpc_server.wait_for_termination())
+            if args.admin:
+                tasks.create_task(self.close_on_termination(admin_server))
+            if args.python_path_reload:
+                from . import reloader
+                path_reloader = reloader.PathReloader(grpc_runner, args.python_path, args.python_path_poll)
+                path_reloader = tasks.create_task(path_reloader.run())
+                tasks.create_task(self.cancel_on_termination(path_reloader))
+            if args.memory_profile:
+                memory_report = tasks.create_task(self.memory_report(grpc_runner, args.memory_interval))
+                tasks.create_task(self.cancel_on_termination(memory_report))
+            if args.packages:
+                from . import packages
+                synced = asyncio.Event()
+                operator = tasks.create_task(packages.operator(
+                    self.stop,
                     grpc_runner,
                     args.packages_secrets,
                     args.packages_namespace,
                     args.packages_dir,
+                    synced,
+                    args.packages_debounce,
+                    args.packages_in_memory,
+                    args.packages_watcher,
                 ))
-        else:
-            def stop():
-                asyncio.ensure_future(grpc_server.stop(5))
-            loop = asyncio.get_event_loop()
-            loop.add_signal_handler(signal.SIGINT, stop)
-            loop.add_signal_handler(signal.SIGTERM, stop)
-            await grpc_server.wait_for_termination()
+                if args.packages_watcher == 'builtin':
+                    tasks.create_task(self.cancel_on_termination(operator))
+                await synced.wait()
+            if not args.packages or args.packages_watcher == 'builtin':
+                # kopf handles the termination signals itself
+                def stop():
+                    asyncio.ensure_future(self.stop())
+                loop = asyncio.get_event_loop()
+                loop.add_signal_handler(signal.SIGINT, stop)
+                loop.add_signal_handler(signal.SIGTERM, stop)
+            if args.warm_up:
+                start = time.monotonic()
+                loaded = await grpc_runner.warm_up(args.warm_up, args.warm_up_compose)
+                logging.getLogger(__name__).info(
+                    f"Warm-up loaded {loaded} of {len(args.warm_up)} composites in {time.monotonic() - start:.3f}s"
+                )
+            await self.set_serving(True)
+            logging.getLogger(__name__).info(f"Serving, startup took {time.monotonic() - self.started:.3f}s")
+        if grpc_runner.capture is not None:
+            grpc_runner.capture.stop()
+
+    async def memory_report(self, runner, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await runner.memory.log(runner)
+
+    async def cancel_on_termination(self, task):
+        await self.grpc_server.wait_for_termination()
+        task.cancel()
+
+    async def close_on_termination(self, server):
+        await self.grpc_server.wait_for_termination()
+        server.close()
+        await server.wait_closed()
+
+    async def set_serving(self, serving):
+        status = health_pb2.HealthCheckResponse.SERVING if serving else health_pb2.HealthCheckResponse.NOT_SERVING
+        await self.health.set(health.OVERALL_HEALTH, status)
+        await self.health.set(function.SERVICE_NAME, status)
+
+    async def stop(self, grace=5):
+        # Report NOT_SERVING while draining
+        await self.health.enter_graceful_shutdown()
+        await self.grpc_server.stop(grace)
 
     def configure_logging(self, args):
-        formatter = Formatter(args.log_name_width)
+        # Records are queued and formatted and written by the listener thread, off the event loop
+        if args.log_format == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = Formatter(args.log_name_width)
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
+        records = queue.SimpleQueue()
+        self.log_listener = logging.handlers.QueueListener(records, handler)
+        self.log_listener.start()
         logger = logging.getLogger()
-        logger.addHandler(handler)
+        logger.addHandler(QueueHandler(records))
         logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
 
 
+# Number of --pip-cache-dir environments kept, including the one in use
+PIP_ENVIRONMENTS = 3
+
+
+def run_pip(*args):
+    # pip is run out of process, it reconfigures logging and is not meant to be invoked repeatedly
+    subprocess.run([sys.executable, '-m', 'pip', *args], check=True)
+
+
+def pip_install_cached(requirements, cache_dir):
+    """Install the requirements into an environment keyed by the lock digest of the requirements.
+
+    Wheels are kept in a persistent wheel directory so later installs do not need the network,
+    and an already installed environment matching the lock is reused without running pip.
+    Returns a description of what was done.
+    """
+    cache_dir = pathlib.Path(cache_dir).expanduser().resolve()
+    lock = pip_lock(requirements)
+    environment = cache_dir / 'environments' / lock
+    if not (environment / '.complete').is_file():
+        wheels = cache_dir / 'wheels'
+        wheels.mkdir(parents=True, exist_ok=True)
+        installing = environment.with_name(f"{lock}.{os.getpid()}")
+        shutil.rmtree(installing, ignore_errors=True)
+        install = ['install', '--quiet', '--no-index', '--find-links', str(wheels), '--target', str(installing), *requirements]
+        try:
+            run_pip(*install)
+            action = f"Installed lock {lock[:12]} from cached wheels"
+        except subprocess.CalledProcessError:
+            run_pip('wheel', '--quiet', '--wheel-dir', str(wheels), *requirements)
+            shutil.rmtree(installing, ignore_errors=True)
+            run_pip(*install)
+            action = f"Installed lock {lock[:12]} from downloaded wheels"
+        (installing / '.complete').write_text(' '.join(requirements))
+        try:
+            installing.rename(environment)
+        except OSError:
+            # Another process completed the same lock first
+            shutil.rmtree(installing, ignore_errors=True)
+    else:
+        # Marks the environment as recently used, see pip_collect
+        os.utime(environment / '.complete')
+        action = f"Reused lock {lock[:12]}"
+    pip_collect(environment)
+    # After the standard library and installed packages, processing any .pth files
+    site.addsitedir(str(environment))
+    return action
+
+
+def pip_collect(environment, keep=PIP_ENVIRONMENTS, abandoned=3600):
+    """Remove all but the keep most recently used environments, and abandoned partial installs.
+
+    Environments used by other processes sharing the cache, such as during a rollout, are kept.
+    """
+    environments = []
+    now = time.time()
+    for path in environment.parent.iterdir():
+        try:
+            if (path / '.complete').is_file():
+                if path != environment:
+                    environments.append(((path / '.complete').stat().st_mtime, path))
+            elif path.is_dir() and now - path.stat().st_mtime > abandoned:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+    for _, path in sorted(environments, reverse=True)[keep - 1:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def pip_lock(requirements):
+    """Return a content digest of the requirements, including any requirement and constraint files."""
+    digest = hashlib.sha256(f"{sys.implementation.cache_tag} {sys.platform}".encode('utf-8'))
+    for requirement in requirements:
+        digest.update(b'\0' + requirement.encode('utf-8'))
+    for path in pip_files(requirements):
+        path = pathlib.Path(path).expanduser()
+        if path.is_file():
+            digest.update(b'\0' + path.read_bytes())
+    return digest.hexdigest()
+
+
+def pip_files(requirements):
+    """Yield the requirement and constraint files of the pip install arguments."""
+    previous = None
+    for requirement in requirements:
+        if previous in ('-r', '--requirement', '-c', '--constraint'):
+            yield requirement
+        elif requirement.startswith(('--requirement=', '--constraint=')):
+            yield requirement.split('=', 1)[1]
+        elif requirement.startswith(('-r', '-c')) and len(requirement) > 2:
+            yield requirement[2:].removeprefix('=')
+        previous = requirement
+
+
+def import_times(modules):
+    """Import the modules in a fresh interpreter, returning each imported module's (self, cumulative) microseconds."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {', '.join(modules)}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:'):
+            fields = line[len('import time:'):].split('|')
+            if len(fields) == 3 and fields[0].strip().isdigit():
+                times[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    return times
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the message arguments, format any traceback, and capture the RunFunction fields
+        # and trace on the logging thread, the rest of the formatting is done by the listener.
+        # As with the stdlib QueueHandler, the queued record holds no exc_info, which would keep
+        # the traceback frames and their locals alive until the listener has written the record.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        # A copy, the request keeps adding fields after the record is queued
+        fields = function.LOG_FIELDS.get()
+        record.fields = dict(fields) if fields else None
+        record.trace = tracing.current()
+        return record
+
+
+EXCEPTION_FORMATTER = logging.Formatter()
+
+
 class Formatter(logging.Formatter):
     def __init__(self, name_width):
         super(Formatter, self).__init__(
@@ -173,20 +591,49 @@ class Formatter(logging.Formatter):
             '{',
         )
         self.name_width = name_width
+        self.snames = {}
 
     def format(self, record):
-        record.sname = record.name
-        extra = len(record.sname) - self.name_width
+        record.sname = self.snames.get(record.name)
+        if record.sname is None:
+            if len(self.snames) > 10000:
+                self.snames.clear()
+            record.sname = self.snames[record.name] = self.sname(record.name)
+        return super(Formatter, self).format(record)
+
+    def sname(self, sname):
+        extra = len(sname) - self.name_width
         if extra > 0:
-            names = record.sname.split('.')
+            names = sname.split('.')
             for ix, name in enumerate(names):
                 if len(name) > extra:
                     names[ix] = name[extra:]
                     break
                 names[ix] = name[:1]
                 extra -= len(name) - 1
-            record.sname = '.'.join(names)
-        return super(Formatter, self).format(record)
+            sname = '.'.join(names)
+        return sname
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        trace = getattr(record, 'trace', None)
+        if trace:
+            entry['trace_id'], entry['span_id'] = trace
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
 
 
 if __name__ == '__main__':
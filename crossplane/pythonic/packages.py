@@ -1,157 +1,633 @@
 
+import asyncio
 import base64
+import contextlib
+import hashlib
 import importlib
+import io
+import json
 import logging
+import os
 import pathlib
+import shutil
 import sys
+import tarfile
+import time
+import zipfile
 
-import kopf
+from . import kube
 
 
-GRPC_SERVER = None
+GRPC_STOP = None
 GRPC_RUNNER = None
-PACKAGE_LABEL = {'function-pythonic.package': kopf.PRESENT}
+PACKAGE_LABEL = 'function-pythonic.package'
 PACKAGES_DIR = None
+# Where package files are stored, either Generations directories or an in memory PackageImporter
+STORE = None
+# The loaded package ConfigMaps and Secrets and their content hashes
+PACKAGES = {}
+# The packages written by sync(), by package_key, until kopf resumes them
+SYNCED = {}
+# Module invalidations are coalesced and applied together after INVALIDATE_DELAY seconds
+# without further changes, or at most INVALIDATE_MAX_DELAY seconds after the first
+INVALIDATE_DELAY = 0.5
+INVALIDATE_MAX_DELAY = 5.0
+INVALIDATE_PENDING = set()
+INVALIDATE_FIRST = None
+INVALIDATE_HANDLE = None
+RELOADING = set()
+# binaryData entries with these suffixes are bundles of a package tree, unpacked into the package
+# Packages kopf has not resumed this long after sync() were deleted since, see expire_synced
+RESUME_GRACE = 60.0
 
+BUNDLE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.xz', '.tar.bz2')
+BUNDLE_MAX_SIZE = 64 * 1024 * 1024
 
-def operator(grpc_server, grpc_runner, packages_secrets, packages_namespaces, packages_dir):
-    logging.getLogger('kopf.objects').setLevel(logging.INFO)
-    global GRPC_SERVER, GRPC_RUNNER, PACKAGES_DIR
-    GRPC_SERVER = grpc_server
+
+async def operator(grpc_stop, grpc_runner, packages_secrets, packages_namespaces, packages_dir, synced=None, debounce=None, in_memory=False, watcher='kopf'):
+    global GRPC_STOP, GRPC_RUNNER, PACKAGES_DIR, STORE, INVALIDATE_DELAY
+    GRPC_STOP = grpc_stop
     GRPC_RUNNER = grpc_runner
+    if debounce is not None:
+        INVALIDATE_DELAY = debounce
     PACKAGES_DIR = pathlib.Path(packages_dir).expanduser().resolve()
-    sys.path.insert(0, str(PACKAGES_DIR))
-    if packages_secrets:
-        kopf.on.create('', 'v1', 'secrets', labels=PACKAGE_LABEL)(create)
-        kopf.on.resume('', 'v1', 'secrets', labels=PACKAGE_LABEL)(create)
-        kopf.on.update('', 'v1', 'secrets', labels=PACKAGE_LABEL)(update)
-        kopf.on.delete('', 'v1', 'secrets', labels=PACKAGE_LABEL)(delete)
-    return kopf.operator(
+    if in_memory:
+        from . import importer
+        STORE = importer.PackageImporter()
+        STORE.install()
+    else:
+        STORE = Generations(PACKAGES_DIR)
+    if watcher == 'builtin':
+        try:
+            client = kube.client()
+        except kube.Unsupported as e:
+            logging.getLogger(__name__).warning(f"{e}, watching packages using kopf")
+        else:
+            async with client:
+                listed = await initial_sync(packages_secrets, packages_namespaces, client)
+                if synced is not None:
+                    synced.set()
+                await watch(client, listed)
+            return
+    import kopf
+    logging.getLogger('kopf.objects').setLevel(logging.INFO)
+    register(kopf, packages_secrets)
+    client = await login(kopf)
+    if client is not None:
+        async with client:
+            await initial_sync(packages_secrets, packages_namespaces, client)
+        asyncio.get_running_loop().call_later(RESUME_GRACE, expire_synced)
+    if synced is not None:
+        synced.set()
+    await kopf.operator(
         standalone=True,
         clusterwide=not packages_namespaces,
         namespaces=packages_namespaces,
     )
 
 
-@kopf.on.startup()
+def register(kopf, packages_secrets):
+    """Register the kopf handlers, kopf is only imported when used."""
+    labels = {PACKAGE_LABEL: kopf.PRESENT}
+    kopf.on.startup()(startup)
+    kopf.on.cleanup()(cleanup)
+    for resource in ['configmaps', 'secrets'] if packages_secrets else ['configmaps']:
+        kopf.on.create('', 'v1', resource, labels=labels)(resume)
+        kopf.on.resume('', 'v1', resource, labels=labels)(resume)
+        kopf.on.update('', 'v1', resource, labels=labels)(update)
+        kopf.on.delete('', 'v1', resource, labels=labels)(delete)
+
+
+async def login(kopf):
+    """Create the sync() client, using kopf's logins if the kubeconfig needs a credential plugin.
+
+    Returns None if no login is available, packages are then only loaded by kopf.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        return kube.client()
+    except kube.Unsupported as e:
+        unsupported = e
+    for login in (kopf.login_via_pykube, kopf.login_via_client):
+        try:
+            info = await asyncio.to_thread(login, logger=logger)
+        except kopf.LoginError:
+            info = None
+        if info is not None:
+            return kube.connected(info)
+    logger.warning(f"{unsupported}, install pykube-ng or kubernetes to sync packages before serving")
+    return None
+
+
+async def initial_sync(packages_secrets, packages_namespaces, client, backoff=1.0, maxBackoff=60.0):
+    """sync() until it succeeds, retrying API server failures with exponential backoff.
+
+    Serving is not ready until the packages are synced, see Main.
+    """
+    delay = backoff
+    while True:
+        try:
+            await client.authenticate()
+            return await sync(packages_secrets, packages_namespaces, client)
+        except (kube.Unauthorized, *kube.TRANSIENT) as e:
+            logging.getLogger(__name__).warning(f"Initial package sync failed, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, maxBackoff)
+
+
+def expire_synced():
+    """Forget the synced packages kopf never resumed, they were deleted before kopf listed them."""
+    if SYNCED:
+        logging.getLogger(__name__).info(f"Packages synced but not resumed: {','.join(sorted(SYNCED))}")
+        SYNCED.clear()
+
+
+async def sync(packages_secrets, packages_namespaces, client=None):
+    """Write all existing packages before serving, returning the listed items and resourceVersions."""
+    logger = logging.getLogger(__name__)
+    resources = ['configmaps', 'secrets'] if packages_secrets else ['configmaps']
+    listed = {}
+    async with contextlib.AsyncExitStack() as stack:
+        if client is None:
+            client = await stack.enter_async_context(kube.client())
+        for resource in resources:
+            for namespace in packages_namespaces or [None]:
+                items, resourceVersion = await client.list(resource, namespace, PACKAGE_LABEL)
+                for body in items:
+                    await create(body, logger)
+                    SYNCED[package_key(body)] = body
+                listed[(resource, namespace)] = (items, resourceVersion)
+    # Remove files of packages reused from a previous process which no longer exist
+    for package, name in STORE.unseen():
+        STORE.remove(package, name)
+        module = module_name(package, name)
+        if module:
+            invalidate_module(module)
+            logger.info(f"Removed module: {module}")
+        else:
+            logger.info(f"Removed file: {'/'.join(package + [name])}")
+        while package and STORE.empty(package):
+            STORE.remove_package(package)
+            invalidate_module('.'.join(package))
+            package.pop()
+    flush_invalidations()
+    logger.info('Initial package sync completed')
+    return listed
+
+
+async def watch(client, listed):
+    """Watch the synced packages with the built in watcher instead of kopf."""
+    # The watchers resume from the listed items themselves
+    SYNCED.clear()
+
+    async def created(body):
+        await create(body, ObjectLogger(body))
+
+    async def updated(body, old):
+        await update(body, old, ObjectLogger(body))
+
+    async def deleted(old):
+        await delete(old, ObjectLogger(old))
+
+    async with asyncio.TaskGroup() as tasks:
+        for (resource, namespace), (items, resourceVersion) in listed.items():
+            watcher = kube.Watcher(
+                client,
+                resource,
+                namespace,
+                PACKAGE_LABEL,
+                created,
+                updated,
+                deleted,
+                items,
+                resourceVersion,
+            )
+            tasks.create_task(watcher.run())
+
+
+class ObjectLogger(logging.LoggerAdapter):
+    """Prefixes messages with the object namespace and name, as the kopf object loggers do."""
+
+    def __init__(self, body):
+        metadata = body.get('metadata', {})
+        super().__init__(logging.getLogger(__name__), {'object': f"{metadata.get('namespace')}/{metadata.get('name')}"})
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['object']}] {msg}", kwargs
+
+
 async def startup(settings, **_):
     settings.scanning.disabled = True
 
 
-@kopf.on.cleanup()
 async def cleanup(**_):
-    await GRPC_SERVER.stop(5)
+    await GRPC_STOP()
 
 
-@kopf.on.create('', 'v1', 'configmaps', labels=PACKAGE_LABEL)
-@kopf.on.resume('', 'v1', 'configmaps', labels=PACKAGE_LABEL)
 async def create(body, logger, **_):
-    package_dir, package = get_package_dir(body)
-    if package_dir:
-        package_dir.mkdir(parents=True, exist_ok=True)
-        secret = body['kind'] == 'Secret'
-        invalidate = False
-        for name, text in body.get('data', {}).items():
-            package_file = package_dir / name
-            if secret:
-                package_file.write_bytes(base64.b64decode(text.encode('utf-8')))
-            else:
-                package_file.write_text(text)
-            if package_file.suffixes == ['.py']:
-                module = '.'.join(package + [package_file.stem])
-                GRPC_RUNNER.invalidate_module(module)
-                logger.info(f"Created module: {module}")
+    package = get_package(body)
+    if package is not None:
+        loaded(body, package)
+        for name, data in package_files(body, logger).items():
+            action = 'Created' if STORE.write(package, name, data) else 'Unchanged'
+            module = module_name(package, name)
+            if module:
+                if action != 'Unchanged':
+                    invalidate_module(module)
+                logger.info(f"{action} module: {module}")
             else:
-                logger.info(f"Created file: {'/'.join(package + [name])}")
+                logger.info(f"{action} file: {'/'.join(package + [name])}")
+
+
+async def resume(body, logger, **_):
+    """kopf create and resume handler, skipping the packages sync() wrote unless they changed since."""
+    old = SYNCED.pop(package_key(body), None)
+    if old is None:
+        await create(body, logger)
+    elif kube.resourceVersion(old) != kube.resourceVersion(body):
+        await update(body, old, logger)
 
 
-@kopf.on.update('', 'v1', 'configmaps', labels=PACKAGE_LABEL)
 async def update(body, old, logger, **_):
-    old_package_dir, old_package = get_package_dir(old)
-    if old_package_dir:
-        old_data = old.get('data', {})
+    old_package = get_package(old)
+    if old_package is not None:
+        old_files = package_files(old)
     else:
-        old_data = {}
-    old_names = set(old_data.keys())
-    package_dir, package = get_package_dir(body, logger)
-    if package_dir:
-        package_dir.mkdir(parents=True, exist_ok=True)
-        secret = body['kind'] == 'Secret'
-        for name, text in body.get('data', {}).items():
-            package_file = package_dir / name
-            if package_dir == old_package_dir and text == old_data.get(name, None):
+        old_files = {}
+    old_names = set(old_files.keys())
+    package = get_package(body, logger)
+    PACKAGES.pop(package_key(old), None)
+    if package is not None:
+        loaded(body, package)
+        for name, data in package_files(body, logger).items():
+            if package == old_package and data == old_files.get(name, None):
+                action = 'Unchanged'
+            elif not STORE.write(package, name, data):
                 action = 'Unchanged'
             else:
-                if secret:
-                    package_file.write_bytes(base64.b64decode(text.encode('utf-8')))
-                else:
-                    package_file.write_text(text)
-                action = 'Updated' if package_dir == old_package_dir and name in old_names else 'Created'
-            if package_file.suffixes == ['.py']:
-                module = '.'.join(package + [package_file.stem])
+                action = 'Updated' if package == old_package and name in old_names else 'Created'
+            module = module_name(package, name)
+            if module:
                 if action != 'Unchanged':
-                    GRPC_RUNNER.invalidate_module(module)
+                    invalidate_module(module)
                 logger.info(f"{action} module: {module}")
             else:
                 logger.info(f"{action} file: {'/'.join(package + [name])}")
-            if package_dir == old_package_dir:
+            if package == old_package:
                 old_names.discard(name)
-    if old_package_dir:
+    if old_package is not None:
         for name in old_names:
-            package_file = old_package_dir / name
-            package_file.unlink(missing_ok=True)
-            if package_file.suffixes == ['.py']:
-                module = '.'.join(old_package + [package_file.stem])
-                GRPC_RUNNER.invalidate_module(module)
+            STORE.remove(old_package, name)
+            module = module_name(old_package, name)
+            if module:
+                invalidate_module(module)
                 logger.info(f"Removed module: {module}")
             else:
                 logger.info(f"Removed file: {'/'.join(old_package + [name])}")
-        while old_package and old_package_dir.is_dir() and not list(old_package_dir.iterdir()):
-            old_package_dir.rmdir()
+        while old_package and STORE.empty(old_package):
+            STORE.remove_package(old_package)
             module = '.'.join(old_package)
-            GRPC_RUNNER.invalidate_module(module)
+            invalidate_module(module)
             logger.info(f"Removed package: {module}")
-            old_package_dir = old_package_dir.parent
             old_package.pop()
 
 
-@kopf.on.delete('', 'v1', 'configmaps', labels=PACKAGE_LABEL)
 async def delete(old, logger, **_):
-    package_dir, package = get_package_dir(old)
-    if package_dir:
-        for name in old.get('data', {}).keys():
-            package_file = package_dir / name
-            package_file.unlink(missing_ok=True)
-            if package_file.suffixes == ['.py']:
-                module = '.'.join(package + [package_file.stem])
-                GRPC_RUNNER.invalidate_module(module)
+    PACKAGES.pop(package_key(old), None)
+    package = get_package(old)
+    if package is not None:
+        for name in package_files(old):
+            STORE.remove(package, name)
+            module = module_name(package, name)
+            if module:
+                invalidate_module(module)
                 logger.info(f"Deleted module: {module}")
             else:
                 logger.info(f"Deleted file: {'/'.join(package + [name])}")
-        while package and package_dir.is_dir() and not list(package_dir.iterdir()):
-            package_dir.rmdir()
+        while package and STORE.empty(package):
+            STORE.remove_package(package)
             module = '.'.join(package)
-            GRPC_RUNNER.invalidate_module(module)
+            invalidate_module(module)
             logger.info(f"Deleted package: {module}")
-            package_dir = package_dir.parent
             package.pop()
 
 
-def get_package_dir(body, logger=None):
+def invalidate_module(module):
+    global INVALIDATE_FIRST, INVALIDATE_HANDLE
+    INVALIDATE_PENDING.add(module)
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    if INVALIDATE_FIRST is None:
+        INVALIDATE_FIRST = now
+    if INVALIDATE_HANDLE is not None:
+        INVALIDATE_HANDLE.cancel()
+    delay = min(INVALIDATE_DELAY, INVALIDATE_FIRST + INVALIDATE_MAX_DELAY - now)
+    INVALIDATE_HANDLE = loop.call_later(max(delay, 0), flush_invalidations)
+
+
+def flush_invalidations():
+    global INVALIDATE_FIRST, INVALIDATE_HANDLE
+    if INVALIDATE_HANDLE is not None:
+        INVALIDATE_HANDLE.cancel()
+    INVALIDATE_FIRST = None
+    INVALIDATE_HANDLE = None
+    modules = sorted(INVALIDATE_PENDING)
+    INVALIDATE_PENDING.clear()
+    # Requests after this point import from the published generation
+    if not STORE.publish():
+        return
+    # Only the changed modules are unloaded, the unchanged modules are moved to the published generation
+    for name, module in list(sys.modules.items()):
+        if name not in modules and STORE.owns(module):
+            STORE.rebase(module)
+    composites = GRPC_RUNNER.invalidate_modules(modules)
+    logging.getLogger(__name__).info(
+        f"Published package generation {STORE.generation}, invalidated {len(modules)} modules in one batch: {','.join(modules)}"
+    )
+    # Load the classes of the unloaded modules again before requests need them
+    if composites:
+        task = asyncio.get_running_loop().create_task(reload(composites))
+        RELOADING.add(task)
+        task.add_done_callback(RELOADING.discard)
+
+
+async def reload(composites):
+    start = time.monotonic()
+    loaded = await GRPC_RUNNER.reload(composites)
+    logging.getLogger(__name__).info(
+        f"Reloaded {loaded} of {len(composites)} composite classes in {time.monotonic() - start:.3f}s"
+    )
+
+
+class Generations:
+    """Package files stored in generation directories under the packages directory.
+
+    Changes are written to a staging copy of the published generation directory, which
+    publish() makes the next generation by switching the current symlink and python path.
+    A manifest of file content hashes is kept with each generation, files are only written
+    if their content changed, and the generation published by a previous process is reused.
+    """
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.generation = 0
+        self.published = None
+        self.previous = None
+        self.staging = None
+        self.collecting = set()
+        self.seen = set()
+        current = self.root / 'current'
+        try:
+            manifest = json.loads((current / MANIFEST).read_text())
+            self.published = current.resolve()
+            self.generation = int(self.published.name)
+        except (OSError, ValueError):
+            manifest = {}
+            self.published = None
+        self.manifest = manifest
+        if (self.root / 'generations').is_dir():
+            for generation_dir in (self.root / 'generations').iterdir():
+                if generation_dir != self.published:
+                    shutil.rmtree(generation_dir, ignore_errors=True)
+        if self.published is not None:
+            sys.path.insert(0, str(self.published))
+
+    def staged(self):
+        if self.staging is None:
+            self.staging = self.root / 'generations' / str(self.generation + 1)
+            shutil.rmtree(self.staging, ignore_errors=True)
+            if self.published is not None:
+                # Files are hard linked, write() replaces rather than modifies them
+                try:
+                    shutil.copytree(self.published, self.staging, copy_function=os.link)
+                except OSError:
+                    shutil.rmtree(self.staging, ignore_errors=True)
+                    shutil.copytree(self.published, self.staging)
+            else:
+                self.staging.mkdir(parents=True)
+        return self.staging
+
+    def path(self, package):
+        return self.staged().joinpath(*package)
+
+    def write(self, package, name, data):
+        """Write the file if its content changed, returning if it was written."""
+        key = '/'.join([*package, name])
+        self.seen.add(key)
+        digest = hashlib.sha256(data).hexdigest()
+        if self.manifest.get(key) == digest:
+            return False
+        package_file = self.path(package) / name
+        package_file.parent.mkdir(parents=True, exist_ok=True)
+        temp = package_file.with_name(f".{package_file.name}.{os.getpid()}")
+        temp.write_bytes(data)
+        os.replace(temp, package_file)
+        self.manifest[key] = digest
+        return True
+
+    def remove(self, package, name):
+        package_dir = self.path(package)
+        package_file = package_dir / name
+        package_file.unlink(missing_ok=True)
+        self.manifest.pop('/'.join([*package, name]), None)
+        # Remove the empty directories of bundled sub packages
+        package_file = package_file.parent
+        while package_file != package_dir and package_file.is_dir() and not list(package_file.iterdir()):
+            package_file.rmdir()
+            package_file = package_file.parent
+
+    def unseen(self):
+        """Return the (package, name) of the files not written since this store was created."""
+        return [
+            (key.split('/')[:-1], key.split('/')[-1])
+            for key in sorted(self.manifest)
+            if key not in self.seen
+        ]
+
+    def empty(self, package):
+        package_dir = self.path(package)
+        return package_dir.is_dir() and not list(package_dir.iterdir())
+
+    def remove_package(self, package):
+        self.path(package).rmdir()
+
+    def publish(self):
+        if self.staging is None:
+            return False
+        previous = self.published
+        self.generation += 1
+        self.published = self.staging
+        self.staging = None
+        # Replaced, as the manifest is hard linked to the previous generation's manifest
+        manifest = self.published / f".{MANIFEST}.{os.getpid()}"
+        manifest.write_text(json.dumps(self.manifest, indent=0, sort_keys=True))
+        os.replace(manifest, self.published / MANIFEST)
+
+        current = self.root / 'current'
+        link = self.root / f".current.{os.getpid()}"
+        link.unlink(missing_ok=True)
+        link.symlink_to(self.published.relative_to(self.root), target_is_directory=True)
+        os.replace(link, current)
+        if previous is not None and str(previous) in sys.path:
+            sys.path[sys.path.index(str(previous))] = str(self.published)
+        else:
+            sys.path.insert(0, str(self.published))
+
+        # Remove the previous generation once the requests which may be using it have completed
+        self.previous = previous
+        if previous is not None:
+            task = asyncio.get_running_loop().create_task(self.collect(previous, set(GRPC_RUNNER.inflight)))
+            self.collecting.add(task)
+            task.add_done_callback(self.collecting.discard)
+        return True
+
+    def rebase(self, module):
+        """Move an unchanged module loaded from the previous generation to the published generation.
+
+        The files are identical, and package __path__s must find new submodules in the published
+        generation once the previous one is removed.
+        """
+        if self.previous is None:
+            return
+        previous = str(self.previous) + os.sep
+        published = str(self.published) + os.sep
+
+        def moved(path):
+            if isinstance(path, str) and path.startswith(previous):
+                return published + path[len(previous):]
+            return path
+
+        for name in ('__file__', '__cached__'):
+            if name in module.__dict__:
+                setattr(module, name, moved(module.__dict__[name]))
+        spec = getattr(module, '__spec__', None)
+        paths = [getattr(module, '__path__', None)]
+        if spec is not None:
+            spec.origin = moved(spec.origin)
+            if spec.cached is not None:
+                spec.cached = moved(spec.cached)
+            paths.append(spec.submodule_search_locations)
+        for path in paths:
+            if isinstance(path, list):
+                path[:] = [moved(entry) for entry in path]
+
+    async def collect(self, generation_dir, inflight):
+        await GRPC_RUNNER.wait_inflight(inflight)
+        await asyncio.to_thread(shutil.rmtree, generation_dir, True)
+        generation_dir = str(generation_dir)
+        for path in list(sys.path_importer_cache):
+            if path == generation_dir or path.startswith(generation_dir + os.sep):
+                del sys.path_importer_cache[path]
+
+    def owns(self, module):
+        path = getattr(module, '__file__', None) or ''
+        return path.startswith(str(self.root / 'generations') + os.sep)
+
+
+MANIFEST = '.manifest.json'
+
+
+def module_name(package, name):
+    name = pathlib.PurePosixPath(name)
+    if name.suffixes == ['.py']:
+        module = package + list(name.parent.parts)
+        if name.stem != '__init__':
+            module.append(name.stem)
+        return '.'.join(module) or None
+    return None
+
+
+def package_files(body, logger=None):
+    """Return the package files of a ConfigMap or Secret, keyed by their path within the package.
+
+    data entries are files, and binaryData entries are files or, if they have a bundle suffix,
+    a zip or tar archive of files and sub package directories.
+    """
+    secret = body.get('kind') == 'Secret'
+    files = {}
+    for name, text in (body.get('data') or {}).items():
+        if secret:
+            data = base64.b64decode(text.encode('utf-8'))
+            if name.endswith(BUNDLE_SUFFIXES):
+                files.update(unbundle(name, data, logger))
+                continue
+        else:
+            data = text.encode('utf-8')
+        files[name] = data
+    for name, text in (body.get('binaryData') or {}).items():
+        data = base64.b64decode(text.encode('utf-8'))
+        if name.endswith(BUNDLE_SUFFIXES):
+            files.update(unbundle(name, data, logger))
+        else:
+            files[name] = data
+    return files
+
+
+def unbundle(bundle, data, logger=None):
+    files = {}
+    size = 0
+
+    def add(name, member_size, read, member):
+        nonlocal size
+        segments = [segment for segment in name.split('/') if segment not in ('', '.')]
+        if not segments or '..' in segments or not all(segment.isidentifier() for segment in segments[:-1]):
+            if logger:
+                logger.error(f"Bundle {bundle} has invalid path: {name}")
+            return
+        size += member_size
+        if size > BUNDLE_MAX_SIZE:
+            raise ValueError(f"larger than {BUNDLE_MAX_SIZE} bytes")
+        files['/'.join(segments)] = read(member)
+
+    try:
+        if bundle.endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir():
+                        add(member.filename, member.file_size, archive.read, member)
+        else:
+            with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+                def extract(member):
+                    return archive.extractfile(member).read()
+                for member in archive.getmembers():
+                    if member.isfile():
+                        add(member.name, member.size, extract, member)
+    except (OSError, ValueError, zipfile.BadZipFile, tarfile.TarError) as e:
+        if logger:
+            logger.error(f"Invalid bundle {bundle}: {e}")
+        return {}
+    return files
+
+
+def get_package(body, logger=None):
     package = body.get('metadata', {}).get('labels', {}).get('function-pythonic.package', None)
     if package is None:
         if logger:
             logger.error('function-pythonic.package label is missing')
-        return None, None
-    package_dir = PACKAGES_DIR
+        return None
     if package == '':
-        package = []
-    else:
-        package = package.split('.')
-        for segment in package:
-            if not segment.isidentifier():
-                if logger:
-                    logger.error('Package has invalid package name: %s', package)
-                return None, None
-            package_dir = package_dir / segment
-    return package_dir, package
+        return []
+    package = package.split('.')
+    for segment in package:
+        if not segment.isidentifier():
+            if logger:
+                logger.error('Package has invalid package name: %s', package)
+            return None
+    return package
+
+
+def loaded(body, package):
+    digest = hashlib.sha256()
+    entries = {**(body.get('data') or {}), **(body.get('binaryData') or {})}
+    for name, text in sorted(entries.items()):
+        digest.update(f"{name}\0{text}\0".encode('utf-8'))
+    PACKAGES[package_key(body)] = {
+        'package': '.'.join(package),
+        'files': sorted(entries.keys()),
+        'hash': digest.hexdigest(),
+    }
+
+
+def package_key(body):
+    metadata = body.get('metadata', {})
+    return f"{body.get('kind', 'ConfigMap')}/{metadata.get('namespace', '')}/{metadata.get('name', '')}"
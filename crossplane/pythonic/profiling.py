@@ -0,0 +1,110 @@
+"""Profiling of selected compose calls, written as pstats files."""
+
+import cProfile
+import datetime
+import logging
+import pathlib
+import random
+import re
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Selects compose calls to run under cProfile.
+
+    A compose is profiled if it matches the filter, is sampled, or follows a compose of the
+    same XR which took longer than the threshold. All settings may be changed at runtime.
+    cProfile profiles the thread, so an awaiting async compose includes the tasks run meanwhile.
+    """
+
+    def __init__(self, directory=None, threshold=None, sample=0.0, filter=None):
+        self.directory = directory
+        self.threshold = threshold
+        self.sample = sample
+        self.filter = filter
+        self.enabled = directory is not None
+        self.armed = set()
+        self.active = False
+        self.profiled = 0
+
+    @property
+    def filter(self):
+        return self._filter
+
+    @filter.setter
+    def filter(self, filter):
+        self._filter = re.compile(filter) if isinstance(filter, str) else filter
+
+    def compose(self, xr, clazz):
+        if not self.enabled or not self.directory:
+            return NOT_PROFILING
+        return Profile(self, xr, clazz)
+
+    def select(self, xr, clazz):
+        if self.active:
+            # cProfile profiles the whole thread, only one compose at a time
+            return False
+        if xr in self.armed:
+            self.armed.discard(xr)
+            return True
+        if self.filter and (self.filter.search(xr) or self.filter.search(clazz)):
+            return True
+        return self.sample > 0 and random.random() < self.sample
+
+    def write(self, profile, xr, clazz, seconds):
+        directory = pathlib.Path(self.directory).expanduser()
+        directory.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S.%f')
+        path = directory / f"{timestamp}-{filename(xr)}-{filename(clazz)}.pstats"
+        profile.dump_stats(str(path))
+        self.profiled += 1
+        logger.info(f"Profiled compose in {seconds:.3f}s: {path}")
+        return path
+
+
+class Profile:
+    def __init__(self, profiler, xr, clazz):
+        self.profiler = profiler
+        self.xr = xr
+        self.clazz = clazz
+        self.profile = None
+
+    def __enter__(self):
+        if self.profiler.select(self.xr, self.clazz):
+            self.profiler.active = True
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        seconds = time.perf_counter() - self.start
+        if self.profile:
+            self.profile.disable()
+            self.profiler.active = False
+            try:
+                self.profiler.write(self.profile, self.xr, self.clazz, seconds)
+            except OSError as e:
+                logger.warning(f"Unable to write compose profile: {e}")
+        elif self.profiler.threshold is not None and seconds > self.profiler.threshold:
+            # Profile the next compose of this XR
+            self.profiler.armed.add(self.xr)
+        return False
+
+
+class NotProfiling:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+NOT_PROFILING = NotProfiling()
+
+
+def filename(name):
+    return re.sub(r'[^\w.-]+', '_', name)
@@ -16,10 +16,10 @@
 ##################################################################################
 
 import datetime
+import functools
 import google.protobuf.struct_pb2
 import json
 import sys
-import yaml
 
 append = sys.maxsize
 
@@ -34,6 +34,7 @@ def Unknown():
     return Values(None, None, None, Values.Type.UNKNOWN)
 
 def Yaml(string, readOnly=None):
+    import yaml
     return _Object(yaml.safe_load(string), readOnly)
 
 def Json(string, readOnly=None):
@@ -888,7 +889,8 @@ def _formatObject(object, spec):
         if isinstance(object, Values):
             return str(object._values)
         return format(object)
-    return yaml.dump(object, Dumper=_Dumper)
+    import yaml
+    return yaml.dump(object, Dumper=_Dumper())
 
 
 class _JSONEncoder(json.JSONEncoder):
@@ -914,28 +916,34 @@ class _JSONEncoder(json.JSONEncoder):
         return super(JSONEncoder, self).default(object)
 
 
-class _Dumper(yaml.SafeDumper):
+@functools.cache
+def _Dumper():
+    # yaml is only imported when first needed, it is not required to serve requests
+    import yaml
 
-    def represent_str(self, data):
-        return self.represent_scalar('tag:yaml.org,2002:str', data, '|' if '\n' in data else None)
+    class _Dumper(yaml.SafeDumper):
 
-    def represent_message_dict(self, message):
-        return self.represent_dict({key: value for key, value in message})
+        def represent_str(self, data):
+            return self.represent_scalar('tag:yaml.org,2002:str', data, '|' if '\n' in data else None)
 
-    def represent_message_list(self, messages):
-        return self.represent_list([value for value in messages])
+        def represent_message_dict(self, message):
+            return self.represent_dict({key: value for key, value in message})
 
-    def represent_values(self, values):
-        if values._isMap:
-            return self.represent_dict({key: value for key, value in values})
-        if values._isList:
-            return self.represent_list([value for value in values])
-        if values._isUnknown:
-            return self.represent_scalar('tag:yaml.org,2002:str', '<<UNKNOWN>>')
-        return self.represent_scalar('tag:yaml.org,2002:str', '<<UNEXPECTED>>')
+        def represent_message_list(self, messages):
+            return self.represent_list([value for value in messages])
 
-_Dumper.add_representer(str, _Dumper.represent_str)
-_Dumper.add_representer(Message, _Dumper.represent_message_dict)
-_Dumper.add_representer(MapMessage, _Dumper.represent_message_dict)
-_Dumper.add_representer(RepeatedMessage, _Dumper.represent_message_list)
-_Dumper.add_representer(Values, _Dumper.represent_values)
+        def represent_values(self, values):
+            if values._isMap:
+                return self.represent_dict({key: value for key, value in values})
+            if values._isList:
+                return self.represent_list([value for value in values])
+            if values._isUnknown:
+                return self.represent_scalar('tag:yaml.org,2002:str', '<<UNKNOWN>>')
+            return self.represent_scalar('tag:yaml.org,2002:str', '<<UNEXPECTED>>')
+
+    _Dumper.add_representer(str, _Dumper.represent_str)
+    _Dumper.add_representer(Message, _Dumper.represent_message_dict)
+    _Dumper.add_representer(MapMessage, _Dumper.represent_message_dict)
+    _Dumper.add_representer(RepeatedMessage, _Dumper.represent_message_list)
+    _Dumper.add_representer(Values, _Dumper.represent_values)
+    return _Dumper
@@ -0,0 +1,192 @@
+"""Hot reload of the modules in the --python-path directories."""
+
+import asyncio
+import ctypes
+import hashlib
+import logging
+import os
+import pathlib
+import sys
+import time
+import types
+
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 2.0
+# inotify events which change the directory contents, or a file once written
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+class PathReloader:
+    """Watches python path directories, unloading the modules whose source changed.
+
+    Changes are detected using inotify where available, otherwise by polling. Names starting
+    with '..' are skipped, as kubelet uses them for the atomic swaps of ConfigMap volumes,
+    whose files are followed through the top level symlinks. Changed modules, and the modules
+    in the watched directories which use them, are unloaded and the cached composite classes
+    are loaded again.
+    """
+
+    def __init__(self, runner, paths, poll=None, delay=0.2):
+        self.runner = runner
+        self.paths = [str(pathlib.Path(path).expanduser().resolve()) for path in paths]
+        self.poll = poll
+        self.delay = delay
+        self.files = {}
+        self.directories = set()
+        self.scan()
+
+    def scan(self):
+        """Return the modules whose source was changed, added, or removed since the last scan."""
+        files = {}
+        directories = set()
+        changed = set()
+        for root in self.paths:
+            for directory, dirnames, filenames in os.walk(root, followlinks=True):
+                directories.add(directory)
+                dirnames[:] = [name for name in dirnames if not name.startswith('..') and name != '__pycache__']
+                for filename in filenames:
+                    if filename.startswith('..') or not filename.endswith('.py'):
+                        continue
+                    path = os.path.join(directory, filename)
+                    module = moduleName(os.path.relpath(path, root))
+                    if module is None:
+                        continue
+                    try:
+                        stat = os.stat(path)
+                        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                        previous = self.files.get(path)
+                        if previous is not None and previous[0] == key:
+                            files[path] = previous
+                            continue
+                        # kubelet rewrites every file of a volume, only content changes count
+                        digest = hashlib.sha256(pathlib.Path(path).read_bytes()).hexdigest()
+                    except OSError:
+                        continue
+                    files[path] = (key, digest, module)
+                    if previous is None or previous[1] != digest:
+                        changed.add(module)
+        for path, (_, _, module) in self.files.items():
+            if path not in files:
+                changed.add(module)
+        self.files = files
+        self.directories = directories
+        return changed
+
+    def dependents(self, modules):
+        """Add the loaded modules in the watched directories which use any of the modules."""
+        modules = set(modules)
+        roots = tuple(os.path.join(root, '') for root in self.paths)
+        while True:
+            found = set()
+            for name, module in list(sys.modules.items()):
+                if name in modules or not (getattr(module, '__file__', None) or '').startswith(roots):
+                    continue
+                for value in list(vars(module).values()):
+                    if isinstance(value, types.ModuleType):
+                        used = value.__name__
+                    elif isinstance(value, (type, types.FunctionType)):
+                        used = value.__module__
+                    else:
+                        continue
+                    if used in modules:
+                        found.add(name)
+                        break
+            if not found:
+                return modules
+            modules |= found
+
+    async def reload(self):
+        modules = await asyncio.to_thread(self.scan)
+        if not modules:
+            return
+        start = time.monotonic()
+        modules = sorted(self.dependents(modules))
+        composites = self.runner.invalidate_modules(modules)
+        loaded = await self.runner.reload(composites)
+        logger.info(
+            f"Python path changed, invalidated {len(modules)} modules: {','.join(modules)}, "
+            f"reloaded {loaded} of {len(composites)} composite classes in {time.monotonic() - start:.3f}s"
+        )
+
+    async def run(self):
+        fd = None if self.poll else inotify()
+        if fd is None:
+            interval = self.poll or POLL_INTERVAL
+            logger.info(f"Polling python path every {interval}s for changes")
+            while True:
+                await asyncio.sleep(interval)
+                await self.reload()
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        loop.add_reader(fd, drain, fd, changed)
+        try:
+            self.watch(fd)
+            logger.info(f"Watching {len(self.directories)} python path directories for changes")
+            while True:
+                await changed.wait()
+                # Coalesce the several steps of a kubelet volume update
+                await asyncio.sleep(self.delay)
+                changed.clear()
+                await self.reload()
+                self.watch(fd)
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+    def watch(self, fd):
+        # Watching a directory again is a no-op, unless a symlink swap replaced the directory
+        for directory in self.directories:
+            if LIBC.inotify_add_watch(fd, os.fsencode(directory), IN_MASK) < 0:
+                logger.warning(f"Unable to watch {directory}: {os.strerror(ctypes.get_errno())}")
+
+
+def moduleName(path):
+    parts = list(pathlib.PurePath(path).with_suffix('').parts)
+    if parts[-1] == '__init__':
+        parts.pop()
+    if not parts or not all(part.isidentifier() for part in parts):
+        return None
+    return '.'.join(parts)
+
+
+def inotify():
+    """Return a non blocking inotify file descriptor, or None if inotify is not available."""
+    if LIBC is None or not hasattr(LIBC, 'inotify_init1'):
+        return None
+    fd = LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        logger.warning(f"Unable to use inotify: {os.strerror(ctypes.get_errno())}")
+        return None
+    return fd
+
+
+def drain(fd, changed):
+    # Every change rescans the directories, so the events themselves are not needed
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+    changed.set()
+
+
+def libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        # The symbols of the running process, which include libc
+        return ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+
+LIBC = libc()
@@ -0,0 +1,338 @@
+"""Render compositions in process, without the crossplane binary or gRPC.
+
+    function-pythonic render [options] XR COMPOSITION
+
+XR is a yaml file, possibly of many documents, or a directory of yaml files. Every XR is
+rendered through the Composition pipeline steps which use function-pythonic, and the
+resulting XR and composed resources are printed as yaml documents.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import pathlib
+import sys
+
+import yaml
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from . import function, protobuf
+
+
+# Crossplane calls a function at most this many times to satisfy its requirements
+MAX_REQUIREMENTS_ITERATIONS = 5
+PYTHONIC_INPUT_GROUPS = ('pythonic.fn.fortra.com', 'pythonic.fn.crossplane.io')
+RENDER_API_VERSION = 'render.crossplane.io/v1beta1'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('function-pythonic render', description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'xr',
+        metavar='XR',
+        help='A yaml file of one or more XRs, or a directory of XR yaml files.',
+    )
+    parser.add_argument(
+        'composition',
+        metavar='COMPOSITION',
+        help='The Composition yaml file.',
+    )
+    parser.add_argument(
+        'functions',
+        metavar='FUNCTIONS',
+        nargs='?',
+        help='Ignored, accepted for command line compatibility with crossplane render.',
+    )
+    parser.add_argument(
+        '--observed-resources', '-o',
+        metavar='FILE',
+        help='A yaml file or directory of observed composed resources.',
+    )
+    parser.add_argument(
+        '--extra-resources', '-e',
+        metavar='FILE',
+        help='A yaml file or directory of resources that can be required by the Composite.',
+    )
+    parser.add_argument(
+        '--context-files',
+        action='append',
+        default=[],
+        metavar='KEY=FILE',
+        help='Set the context key to the contents of the json or yaml file.',
+    )
+    parser.add_argument(
+        '--context-values',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='Set the context key to the json or yaml value.',
+    )
+    parser.add_argument(
+        '--include-context', '-c',
+        action='store_true',
+        help='Include the context in the output.',
+    )
+    parser.add_argument(
+        '--include-function-results', '-r',
+        action='store_true',
+        help='Include the function results in the output.',
+    )
+    parser.add_argument(
+        '--function-name',
+        action='append',
+        default=[],
+        metavar='NAME',
+        help='Run the pipeline steps using this function, in addition to steps with function-pythonic input.',
+    )
+    parser.add_argument(
+        '--python-path',
+        action='append',
+        default=[],
+        metavar='DIRECTORY',
+        help='Filing system directories to add to the python path',
+    )
+    parser.add_argument(
+        '--debug', '-d',
+        action='store_true',
+        help='Emit debug logs.',
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format='%(levelname)s %(name)s %(message)s',
+        stream=sys.stderr,
+    )
+    for path in reversed(args.python_path):
+        sys.path.insert(0, str(pathlib.Path(path).expanduser().resolve()))
+    try:
+        render = Render(
+            loadComposition(args.composition),
+            loadDocuments(args.observed_resources),
+            loadDocuments(args.extra_resources),
+            loadContext(args.context_files, args.context_values),
+            args.function_name or ['function-pythonic'],
+        )
+    except RenderError as e:
+        print(f"Render failed: {e}", file=sys.stderr)
+        return 1
+    return asyncio.run(renderAll(render, loadDocuments(args.xr), args.include_function_results, args.include_context))
+
+
+async def renderAll(render, xrs, results=False, context=False):
+    """Render every XR in one event loop, printing the yaml documents, returning the exit code."""
+    failed = False
+    for xr in xrs:
+        try:
+            documents = await render.render(xr)
+        except RenderError as e:
+            print(f"Render of {xr.get('kind')}/{xr.get('metadata', {}).get('name')} failed: {e}", file=sys.stderr)
+            failed = True
+            continue
+        for document in documents:
+            if document['kind'] == 'Result' and not results:
+                continue
+            if document['kind'] == 'Context' and not context:
+                continue
+            sys.stdout.write('---\n')
+            sys.stdout.write(yaml.dump(document, Dumper=protobuf._Dumper()))
+    sys.stdout.flush()
+    return 1 if failed else 0
+
+
+class RenderError(Exception):
+    pass
+
+
+class Render:
+    """Runs the function-pythonic steps of a Composition pipeline for XRs.
+
+    One FunctionRunner is used for every XR, so composite classes are loaded only once.
+    """
+
+    def __init__(self, composition, observed=None, extra=None, context=None, functions=('function-pythonic',)):
+        if composition.get('spec', {}).get('mode', 'Pipeline') != 'Pipeline':
+            raise RenderError('Only Pipeline mode Compositions are supported')
+        self.steps = composition.get('spec', {}).get('pipeline') or []
+        self.observed = observed or []
+        self.extra = extra or []
+        self.context = context or {}
+        self.functions = functions
+        self.runner = function.FunctionRunner()
+
+    def pythonic(self, step):
+        if step.get('functionRef', {}).get('name') in self.functions:
+            return True
+        group = (step.get('input') or {}).get('apiVersion', '').split('/')[0]
+        return group in PYTHONIC_INPUT_GROUPS
+
+    async def render(self, xr):
+        """Return the rendered XR, composed resources, results, and context documents."""
+        desired = fnv1.State()
+        context = fnv1.RunFunctionRequest().context
+        context.update(self.context)
+        results = []
+        conditions = []
+        for step in self.steps:
+            name = step.get('step')
+            if not self.pythonic(step):
+                logging.getLogger(__name__).warning(
+                    f"Skipping step {name}, function {step.get('functionRef', {}).get('name')} is not function-pythonic"
+                )
+                continue
+            response = await self.step(xr, step, desired, context)
+            desired = response.desired
+            context = response.context
+            for result in response.results:
+                results.append({
+                    'apiVersion': RENDER_API_VERSION,
+                    'kind': 'Result',
+                    'step': name,
+                    'severity': enumName(fnv1.Severity, result.severity, 'SEVERITY_'),
+                    'reason': result.reason,
+                    'message': result.message,
+                })
+                if result.severity == fnv1.SEVERITY_FATAL:
+                    raise RenderError(f"step {name}: {result.message}")
+            conditions.extend(response.conditions)
+
+        composite = valueDict(desired.composite.resource)
+        rendered = {
+            'apiVersion': xr['apiVersion'],
+            'kind': xr['kind'],
+            'metadata': dict(xr.get('metadata', {})),
+        }
+        status = merge(dict(xr.get('status') or {}), composite.get('status') or {})
+        for condition in conditions:
+            status.setdefault('conditions', []).append({
+                'type': condition.type,
+                'status': enumName(fnv1.Status, condition.status, 'STATUS_CONDITION_'),
+                'reason': condition.reason,
+                'message': condition.message,
+            })
+        if status:
+            rendered['status'] = status
+        documents = [rendered]
+        xrName = xr.get('metadata', {}).get('name', '')
+        for name, resource in sorted(desired.resources.items()):
+            resource = valueDict(resource.resource)
+            metadata = resource.setdefault('metadata', {})
+            if 'name' not in metadata:
+                metadata['generateName'] = f"{xrName}-"
+            metadata.setdefault('annotations', {})['crossplane.io/composition-resource-name'] = name
+            metadata.setdefault('labels', {})['crossplane.io/composite'] = xrName
+            documents.append(resource)
+        documents.extend(results)
+        documents.append({
+            'apiVersion': RENDER_API_VERSION,
+            'kind': 'Context',
+            'fields': valueDict(context),
+        })
+        return documents
+
+    async def step(self, xr, step, desired, context):
+        """Run the step until its requirements are satisfied, returning the last response."""
+        requirements = b''
+        extra = {}
+        for _ in range(MAX_REQUIREMENTS_ITERATIONS):
+            request = fnv1.RunFunctionRequest()
+            request.meta.tag = step.get('step', '')
+            request.observed.composite.resource.update(xr)
+            for resource in self.observed:
+                name = resource.get('metadata', {}).get('annotations', {}).get('crossplane.io/composition-resource-name')
+                if name:
+                    request.observed.resources[name].resource.update(resource)
+            request.desired.CopyFrom(desired)
+            request.context.CopyFrom(context)
+            request.input.update(step.get('input') or {})
+            for name, resources in extra.items():
+                request.extra_resources[name].SetInParent()
+                for resource in resources:
+                    request.extra_resources[name].items.add().resource.update(resource)
+            response = function.Response(request, await self.runner.run_function(request)).message()
+            current = response.requirements.SerializeToString(deterministic=True)
+            if current == requirements:
+                break
+            requirements = current
+            extra = {
+                name: [resource for resource in self.extra if selected(selector, resource)]
+                for name, selector in response.requirements.extra_resources.items()
+            }
+            # The context is passed down across iterations, as crossplane does
+            context = response.context
+        return response
+
+
+def selected(selector, resource):
+    if resource.get('apiVersion') != selector.api_version or resource.get('kind') != selector.kind:
+        return False
+    metadata = resource.get('metadata') or {}
+    if selector.namespace and metadata.get('namespace') != selector.namespace:
+        return False
+    if selector.WhichOneof('match') == 'match_name':
+        return metadata.get('name') == selector.match_name
+    labels = metadata.get('labels') or {}
+    return all(labels.get(key) == value for key, value in selector.match_labels.labels.items())
+
+
+def valueDict(struct):
+    return {key: value(entry) for key, entry in struct.fields.items()}
+
+
+def value(entry):
+    kind = entry.WhichOneof('kind')
+    if kind == 'struct_value':
+        return valueDict(entry.struct_value)
+    if kind == 'list_value':
+        return [value(item) for item in entry.list_value.values]
+    if kind == 'number_value':
+        number = entry.number_value
+        return int(number) if number.is_integer() else number
+    if kind in ('string_value', 'bool_value'):
+        return getattr(entry, kind)
+    return None
+
+
+def merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            target[key] = merge(dict(target[key]), value)
+        else:
+            target[key] = value
+    return target
+
+
+def enumName(enum, number, prefix):
+    return enum.Name(number).removeprefix(prefix).capitalize()
+
+
+def loadDocuments(path):
+    if not path:
+        return []
+    path = pathlib.Path(path).expanduser()
+    paths = sorted(path.glob('*.y*ml')) if path.is_dir() else [path]
+    documents = []
+    for path in paths:
+        for document in yaml.safe_load_all(path.read_text()):
+            if isinstance(document, dict):
+                documents.append(document)
+    return documents
+
+
+def loadComposition(path):
+    for document in loadDocuments(path):
+        if document.get('kind') == 'Composition':
+            return document
+    raise RenderError(f"No Composition found in {path}")
+
+
+def loadContext(files, values):
+    context = {}
+    for entry in files:
+        key, _, path = entry.partition('=')
+        context[key] = yaml.safe_load(pathlib.Path(path).expanduser().read_text())
+    for entry in values:
+        key, _, text = entry.partition('=')
+        context[key] = yaml.safe_load(text)
+    # yaml parses timestamps, context values are json
+    return json.loads(json.dumps(context, default=str))
@@ -0,0 +1,216 @@
+"""Replay captured requests, reporting latencies and differences from the captured responses.
+
+    function-pythonic replay [options] CAPTURE [CAPTURE ...]
+
+CAPTURE is a file written by --capture-dir, or a directory of them. Requests are run in
+process through a FunctionRunner, or sent to a running function-pythonic using --address.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import pathlib
+import statistics
+import sys
+import time
+
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from . import capture, function
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('function-pythonic replay', description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'captures',
+        metavar='CAPTURE',
+        nargs='+',
+        help='Capture files, or directories of capture files.',
+    )
+    parser.add_argument(
+        '--address',
+        metavar='ADDRESS',
+        help='Send the requests to the function-pythonic gRPC address instead of running them in process.',
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=1,
+        metavar='COUNT',
+        help='Number of requests to run concurrently, default 1',
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        metavar='PER_SECOND',
+        help='Requests to start per second, default as fast as possible.',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=1,
+        metavar='COUNT',
+        help='Number of times to replay the captured requests, default 1',
+    )
+    parser.add_argument(
+        '--differences',
+        type=int,
+        default=10,
+        metavar='COUNT',
+        help='Number of differing responses to describe, default 10',
+    )
+    parser.add_argument(
+        '--python-path',
+        action='append',
+        default=[],
+        metavar='DIRECTORY',
+        help='Filing system directories to add to the python path',
+    )
+    parser.add_argument(
+        '--debug', '-d',
+        action='store_true',
+        help='Emit debug logs.',
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format='%(levelname)s %(name)s %(message)s',
+        stream=sys.stderr,
+    )
+    for path in reversed(args.python_path):
+        sys.path.insert(0, str(pathlib.Path(path).expanduser().resolve()))
+
+    records = []
+    for captures in args.captures:
+        captures = pathlib.Path(captures).expanduser()
+        for path in sorted(captures.glob('capture-*.binpb.gz')) if captures.is_dir() else [captures]:
+            records.extend(capture.read(path))
+    if not records:
+        print('No captured requests found', file=sys.stderr)
+        return 1
+    report = asyncio.run(replay(records * args.repeat, args.address, args.concurrency, args.rate))
+    print(report.format(args.differences))
+    return 1 if report.errors or report.differences else 0
+
+
+async def replay(records, address=None, concurrency=1, rate=None):
+    """Run the (request, response) records, returning the Report."""
+    if address:
+        import grpc
+        from crossplane.function.proto.v1 import run_function_pb2_grpc as grpcv1
+        channel = grpc.aio.insecure_channel(address)
+        stub = grpcv1.FunctionRunnerServiceStub(channel)
+
+        async def call(request, data):
+            return await stub.RunFunction(request)
+    else:
+        channel = None
+        runner = function.FunctionRunner()
+
+        async def call(request, data):
+            return (await runner.ServeFunction(request, None, data)).message()
+
+    report = Report()
+    loop = asyncio.get_running_loop()
+    # Shared by the workers, next() is never interrupted by another worker
+    pending = enumerate(records)
+    start = loop.time()
+
+    async def worker():
+        for ix, (request, expected) in pending:
+            if rate:
+                delay = start + ix / rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            data = request
+            request = fnv1.RunFunctionRequest.FromString(data)
+            started = time.perf_counter()
+            try:
+                response = await call(request, data)
+            except Exception as e:
+                report.error(request, e)
+                continue
+            report.latencies.append(time.perf_counter() - started)
+            # Compared as captured
+            capture.redact(response)
+            report.compare(request, fnv1.RunFunctionResponse.FromString(expected), response)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+    finally:
+        if channel is not None:
+            await channel.close()
+    report.seconds = loop.time() - start
+    return report
+
+
+class Report:
+    def __init__(self):
+        self.latencies = []
+        self.seconds = 0.0
+        self.errors = []
+        self.differences = []
+
+    def error(self, request, error):
+        self.errors.append((xrName(request), f"{error.__class__.__name__}: {error}"))
+
+    def compare(self, request, expected, response):
+        if expected.SerializeToString(deterministic=True) == response.SerializeToString(deterministic=True):
+            return
+        self.differences.append((xrName(request), sorted(differences(expected, response))))
+
+    def format(self, limit=10):
+        lines = [f"Requests: {len(self.latencies) + len(self.errors)} in {self.seconds:.3f}s"]
+        if self.seconds:
+            lines[0] += f", {len(self.latencies) / self.seconds:.1f}/s"
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            lines.append(
+                'Latency ms: '
+                f"min {latencies[0] * 1000:.3f}, "
+                f"p50 {percentile(latencies, 50) * 1000:.3f}, "
+                f"p90 {percentile(latencies, 90) * 1000:.3f}, "
+                f"p99 {percentile(latencies, 99) * 1000:.3f}, "
+                f"max {latencies[-1] * 1000:.3f}, "
+                f"mean {statistics.fmean(latencies) * 1000:.3f}"
+            )
+        lines.append(f"Errors: {len(self.errors)}")
+        for name, error in self.errors[:limit]:
+            lines.append(f"  {name}: {error}")
+        lines.append(f"Differences: {len(self.differences)}")
+        for name, paths in self.differences[:limit]:
+            lines.append(f"  {name}: {', '.join(itertools.islice(paths, 10))}")
+        return '\n'.join(lines)
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def differences(expected, actual, path=''):
+    """Yield the field paths whose values differ between the two messages or values."""
+    expected = asDict(expected)
+    actual = asDict(actual)
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in expected.keys() | actual.keys():
+            yield from differences(expected.get(key), actual.get(key), f"{path}.{key}" if path else str(key))
+    elif isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        for ix, (left, right) in enumerate(zip(expected, actual)):
+            yield from differences(left, right, f"{path}[{ix}]")
+    elif expected != actual:
+        yield path or '<root>'
+
+
+def asDict(value):
+    if hasattr(value, 'DESCRIPTOR'):
+        from google.protobuf import json_format
+        return json_format.MessageToDict(value)
+    return value
+
+
+def xrName(request):
+    resource = request.observed.composite.resource
+    if 'metadata' in resource and 'name' in resource['metadata']:
+        return f"{resource['kind'] if 'kind' in resource else ''}/{resource['metadata']['name']}"
+    return '<unknown>'
@@ -0,0 +1,158 @@
+"""Lightweight tracing of RunFunction phases, exported as OTLP json lines."""
+
+import contextvars
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+
+EXPORTER = None
+CURRENT = contextvars.ContextVar('CURRENT_SPAN', default=None)
+
+
+def configure(path):
+    """Export finished traces to the file path, or stdout if the path is '-'."""
+    global EXPORTER
+    if EXPORTER:
+        EXPORTER.stop()
+    EXPORTER = Exporter(path) if path else None
+
+
+def span(name, **attributes):
+    """Return a context manager recording a span, a no-op context manager if tracing is not configured."""
+    if EXPORTER is None:
+        return NOT_RECORDING
+    return Span(name, attributes)
+
+
+def current():
+    """Return the (trace_id, span_id) of the active span, or None."""
+    active = CURRENT.get()
+    if active is None:
+        return None
+    return active.trace_id, active.span_id
+
+
+class NotRecording:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+
+NOT_RECORDING = NotRecording()
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.parent = CURRENT.get()
+        if self.parent:
+            self.trace_id = self.parent.trace_id
+            self.trace = self.parent.trace
+        else:
+            self.trace_id = f"{random.getrandbits(128):032x}"
+            self.trace = []
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.error = None
+
+    def __setitem__(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        self.token = CURRENT.set(self)
+        return self
+
+    def __exit__(self, _, exception, __):
+        self.end = time.time_ns()
+        CURRENT.reset(self.token)
+        if exception is not None:
+            self.error = f"{exception.__class__.__name__}: {exception}"
+        self.trace.append(self)
+        if self.parent is None and EXPORTER is not None:
+            EXPORTER.export(self.trace)
+        return False
+
+    def otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [
+                {'key': key, 'value': otlpValue(value)}
+                for key, value in self.attributes.items()
+            ],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 0},
+        }
+        if self.parent:
+            span['parentSpanId'] = self.parent.span_id
+        return span
+
+
+def otlpValue(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Exporter:
+    """Writes each finished trace as an OTLP json line from a background thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.traces = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='pythonic-tracing', daemon=True)
+        self.thread.start()
+
+    def export(self, trace):
+        self.traces.put(trace)
+
+    def stop(self):
+        self.traces.put(None)
+        self.thread.join()
+
+    def run(self):
+        if self.path == '-':
+            output = sys.stdout
+        else:
+            output = open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                trace = self.traces.get()
+                if trace is None:
+                    break
+                output.write(json.dumps(otlp(trace), separators=(',', ':')) + '\n')
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+
+def otlp(trace):
+    return {
+        'resourceSpans': [{
+            'resource': {
+                'attributes': [{'key': 'service.name', 'value': {'stringValue': 'function-pythonic'}}],
+            },
+            'scopeSpans': [{
+                'scope': {'name': 'crossplane.pythonic'},
+                'spans': [span.otlp() for span in trace],
+            }],
+        }],
+    }
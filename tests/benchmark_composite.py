@@ -0,0 +1,35 @@
+# Run with: python -m tests.benchmark_composite
+
+import timeit
+
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from crossplane.pythonic import composite
+
+
+def main(number=10000):
+    request = fnv1.RunFunctionRequest()
+    request.observed.composite.resource.update({
+        'apiVersion': 'pythonic.fortra.com/v1alpha1',
+        'kind': 'Benchmark',
+        'metadata': {'name': 'benchmark'},
+        'spec': {'size': 3},
+    })
+    response = fnv1.RunFunctionResponse()
+
+    def instantiate():
+        composite.BaseComposite(request, response, None)
+
+    def instantiate_and_touch():
+        instance = composite.BaseComposite(request, response, None)
+        instance.credentials, instance.environment, instance.requireds, instance.resources
+        instance.status, instance.conditions, instance.connection, instance.events
+        instance.apiVersion, instance.kind, instance.metadata, instance.spec
+
+    for name, function in (('instantiate', instantiate), ('instantiate all helpers', instantiate_and_touch)):
+        seconds = min(timeit.repeat(function, number=number, repeat=5))
+        print(f"{name:24} {seconds / number * 1e6:8.2f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import pytest
+
+from crossplane.pythonic import admin, function, profiling
+
+
+async def http(port, method, path, headers=''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n{headers}\r\n".encode('latin-1'))
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b'\r\n\r\n', 1)
+    return int(head.split()[1]), json.loads(body)
+
+
+@pytest.mark.asyncio
+async def test_admin(tmp_path):
+    runner = function.FunctionRunner()
+    await runner.warm_up(['tests.fn_cases.clazz.TestComposite'])
+    runner.get_clazz('tests.fn_cases.clazz.TestComposite', function.logger)
+    server = await admin.Admin(runner).start('127.0.0.1:0')
+    port = server.sockets[0].getsockname()[1]
+    try:
+        status, body = await http(port, 'GET', '/classes')
+        assert status == 200
+        assert body == [{'class': 'tests.fn_cases.clazz.TestComposite', 'hits': 2}]
+
+        status, body = await http(port, 'GET', '/requests')
+        assert body == {'inflight': [], 'slowSeconds': 1.0, 'slow': []}
+
+        status, body = await http(port, 'POST', '/profile?xr=example/v1/XR/slow')
+        assert status == 409
+
+        runner.profiler = profiling.Profiler(tmp_path)
+        status, body = await http(port, 'POST', '/profile?xr=example/v1/XR/slow')
+        assert status == 200
+        assert body['armed'] == ['example/v1/XR/slow']
+
+        status, body = await http(port, 'POST', '/invalidate')
+        assert status == 200
+        assert not runner.clazzes
+
+        status, body = await http(port, 'GET', '/missing')
+        assert status == 404
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_admin_limits(monkeypatch):
+    runner = function.FunctionRunner()
+    with pytest.raises(ValueError):
+        await admin.Admin(runner).start('0.0.0.0:0')
+    monkeypatch.setattr(admin, 'READ_TIMEOUT', 0.1)
+    server = await admin.Admin(runner, 'secret').start('127.0.0.1:0')
+    port = server.sockets[0].getsockname()[1]
+    try:
+        status, body = await http(port, 'GET', '/classes')
+        assert status == 401
+        status, body = await http(port, 'GET', '/classes', 'Authorization: Bearer secret\r\n')
+        assert status == 200
+
+        status, body = await http(port, 'POST', '/invalidate')
+        assert status == 401
+        status, body = await http(port, 'POST', '/invalidate', 'Authorization: Bearer wrong\r\n')
+        assert status == 401
+        status, body = await http(port, 'POST', '/invalidate', 'Authorization: Bearer secret\r\n')
+        assert status == 200
+
+        status, body = await http(port, 'GET', '/' + 'x' * admin.MAX_LINE)
+        assert status == 400
+        status, body = await http(port, 'GET', '/classes', 'X-Header: value\r\n' * (admin.MAX_HEADERS + 1))
+        assert status == 431
+
+        # A client which never finishes its headers is disconnected
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /classes HTTP/1.1\r\n')
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        assert response.startswith(b'HTTP/1.1 408 ')
+    finally:
+        server.close()
+        await server.wait_closed()
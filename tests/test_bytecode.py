@@ -0,0 +1,46 @@
+import builtins
+import importlib
+import sys
+
+from crossplane.pythonic import bytecode
+
+
+def test_bytecode_cache(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'cachedmodule.py').write_text('VALUE = 1\n')
+    monkeypatch.setattr(sys, 'path_hooks', list(sys.path_hooks))
+    monkeypatch.setattr(sys, 'path_importer_cache', {})
+    monkeypatch.setattr(sys, 'path', [str(source), *sys.path])
+    monkeypatch.setattr(bytecode, 'CACHE_DIR', None)
+    bytecode.install(tmp_path / 'cache')
+
+    compiles = []
+    compile = builtins.compile
+    def counting(*args, **kwargs):
+        compiles.append(args[1])
+        return compile(*args, **kwargs)
+    monkeypatch.setattr(builtins, 'compile', counting)
+
+    try:
+        assert importlib.import_module('cachedmodule').VALUE == 1
+        del sys.modules['cachedmodule']
+        assert importlib.import_module('cachedmodule').VALUE == 1
+    finally:
+        sys.modules.pop('cachedmodule', None)
+    assert compiles == [str(source / 'cachedmodule.py')]
+    assert not (source / '__pycache__').exists()
+
+    script = 'class Composite:\n    pass\n'
+    assert bytecode.compile(script, '<string>') is not None
+    namespace = {}
+    exec(bytecode.compile(script, '<string>'), namespace)
+    assert 'Composite' in namespace
+    assert compiles == [str(source / 'cachedmodule.py'), '<string>']
+
+    (source / 'cachedmodule.py').write_text('VALUE = 2\n')
+    try:
+        assert importlib.import_module('cachedmodule').VALUE == 2
+    finally:
+        sys.modules.pop('cachedmodule', None)
+    assert len(compiles) == 3
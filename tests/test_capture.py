@@ -0,0 +1,110 @@
+import gzip
+
+import pytest
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from crossplane.pythonic import capture, function, replay
+
+
+COMPOSITE = '''
+class Composite(BaseComposite):
+    def compose(self):
+        self.resources.bucket('s3.aws.upbound.io/v1beta1', 'Bucket').spec.forProvider.region = self.spec.region
+'''
+
+
+def request(ix):
+    request = fnv1.RunFunctionRequest()
+    request.observed.composite.resource.update({
+        'apiVersion': 'example.crossplane.io/v1',
+        'kind': 'XR',
+        'metadata': {'name': f"xr-{ix}"},
+        'spec': {'region': f"region-{ix}"},
+    })
+    request.input.update({'composite': COMPOSITE})
+    request.credentials['aws'].credential_data.data['key'] = b'secret'
+    request.observed.composite.connection_details['password'] = b'secret'
+    request.extra_resources['secret'].items.add().resource.update({
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': {'name': 'secret'},
+        'data': {'token': 'c2VjcmV0'},
+    })
+    return request
+
+
+@pytest.mark.asyncio
+async def test_capture_replay(tmp_path):
+    runner = function.FunctionRunner()
+    runner.capture = capture.Capture(tmp_path, fileSize=1, files=2)
+    for ix in range(4):
+        await runner.ServeFunction(request(ix), None)
+    runner.capture.stop()
+
+    # Every record started a new file, only the newest two are kept
+    paths = sorted(tmp_path.glob('capture-*.binpb.gz'))
+    assert len(paths) == 2
+    records = [record for path in paths for record in capture.read(path)]
+    assert len(records) == 2
+    captured = fnv1.RunFunctionRequest.FromString(records[0][0])
+    assert captured.observed.composite.resource['metadata']['name'] == 'xr-2'
+    assert captured.credentials['aws'].credential_data.data['key'] == capture.REDACTED
+    assert captured.observed.composite.connection_details['password'] == capture.REDACTED
+    assert captured.extra_resources['secret'].items[0].resource['data']['token'] == '<<REDACTED>>'
+    # The captured request is not composed
+    assert len(captured.desired.resources) == 0
+    assert len(fnv1.RunFunctionResponse.FromString(records[0][1]).desired.resources) == 1
+
+    report = await replay.replay(records * 5, concurrency=3)
+    assert len(report.latencies) == 10
+    assert report.errors == []
+    assert report.differences == []
+
+    response = fnv1.RunFunctionResponse.FromString(records[1][1])
+    response.desired.resources['bucket'].resource['spec']['forProvider']['region'] = 'changed'
+    report = await replay.replay([(records[1][0], response.SerializeToString())], rate=100)
+    assert report.differences == [('XR/xr-3', ['desired.resources.bucket.resource.spec.forProvider.region'])]
+    assert 'Differences: 1' in report.format()
+
+
+SECRET = '''
+class Composite(BaseComposite):
+    def compose(self):
+        self.connection.password = b'secret'
+        secret = self.resources.secret('v1', 'Secret')
+        secret.data.token = 'c2VjcmV0'
+        secret.desired.stringData.password = 'secret'
+'''
+
+
+@pytest.mark.asyncio
+async def test_capture_response_redacted(tmp_path):
+    runner = function.FunctionRunner()
+    runner.capture = capture.Capture(tmp_path)
+    composed = request(0)
+    composed.input.update({'composite': SECRET})
+    served = await runner.ServeFunction(composed, None)
+    runner.capture.stop()
+
+    # The served response is not redacted
+    assert served.message().desired.composite.connection_details['password'] == b'secret'
+    records = [record for path in tmp_path.glob('capture-*.binpb.gz') for record in capture.read(path)]
+    assert len(records) == 1
+    response = fnv1.RunFunctionResponse.FromString(records[0][1])
+    assert response.desired.composite.connection_details['password'] == capture.REDACTED
+    secret = response.desired.resources['secret']
+    assert secret.resource['data']['token'] == '<<REDACTED>>'
+    assert secret.resource['stringData']['password'] == '<<REDACTED>>'
+    assert b'c2VjcmV0' not in records[0][1]
+
+    # Replay compares the redacted responses
+    report = await replay.replay(records)
+    assert report.errors == []
+    assert report.differences == []
+
+
+def test_truncated(tmp_path):
+    path = tmp_path / 'capture-truncated.binpb.gz'
+    with gzip.open(path, 'wb') as output:
+        output.write(function.varint(3) + b'abc' + function.varint(10) + b'short')
+    assert list(capture.read(path)) == []
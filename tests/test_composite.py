@@ -0,0 +1,28 @@
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from crossplane.pythonic import composite
+
+
+def test_lazy_helpers():
+    request = fnv1.RunFunctionRequest()
+    request.observed.composite.resource.update({'spec': {'size': 3}})
+    response = fnv1.RunFunctionResponse()
+    instance = composite.BaseComposite(request, response, None)
+    for name in ('credentials', 'context', 'environment', 'requireds', 'resources', 'status', 'conditions', 'connection', 'events', 'spec'):
+        assert name not in instance.__dict__
+    assert instance.spec.size == 3
+    assert instance.spec is instance.spec
+    assert 'spec' in instance.__dict__
+    assert 'status' not in instance.__dict__
+    instance.status.size = instance.spec.size
+    assert response.desired.composite.resource['status']['size'] == 3
+
+
+def test_helper_override():
+    class Composite(composite.BaseComposite):
+        def __init__(self, request, response, logger):
+            super().__init__(request, response, logger)
+            self.spec = 'overridden'
+
+    instance = Composite(fnv1.RunFunctionRequest(), fnv1.RunFunctionResponse(), None)
+    assert instance.spec == 'overridden'
@@ -73,3 +73,116 @@ async def test_run_function(fn_case):
     )
 
     assert response == test['response']
+
+
+@pytest.mark.parametrize(
+    'fn_case',
+    [
+        path
+        for path in (pathlib.Path(__file__).parent / 'fn_cases').iterdir()
+        if path.is_file() and path.suffix == '.yaml'
+    ],
+)
+@pytest.mark.asyncio
+async def test_serialize_response(fn_case):
+    test = utils.yaml_load(fn_case.read_text())
+    request = fnv1.RunFunctionRequest()
+    request.observed.composite.resource.update({
+        'apiVersion': 'pythonic.fortra.com/v1alpha1',
+        'kind': 'PyTest',
+        'metadata': {
+            'name': fn_case.stem,
+        },
+    })
+    request.desired.resources['previous'].resource.update({'apiVersion': 'v1', 'kind': 'ConfigMap'})
+    utils.message_merge(request, test['request'])
+
+    response = await function.FunctionRunner().ServeFunction(request, None)
+
+    assert fnv1.RunFunctionResponse.FromString(response.SerializeToString()) == response.message()
+
+
+def test_response_merge():
+    request = fnv1.RunFunctionRequest()
+    request.desired.composite.resource.update({'status': {'composed': True}})
+    request.desired.resources['bucket'].resource.update({'kind': 'Bucket'})
+    request.context.update({'iteration': 1})
+    response = fnv1.RunFunctionResponse()
+    response.desired.resources['other'].resource.update({'kind': 'ConfigMap'})
+    response.desired.resources['bucket'].ready = fnv1.Ready.READY_TRUE
+    response.context.update({'other': 'value'})
+    response = function.Response(request, response)
+
+    message = response.message()
+    assert fnv1.RunFunctionResponse.FromString(response.SerializeToString()) == message
+    assert sorted(message.desired.resources) == ['bucket', 'other']
+    assert sorted(message.context) == ['iteration', 'other']
+    # Repeated message fields take the last value, as with parsing
+    assert message.desired.resources['bucket'].ready == fnv1.Ready.READY_UNSPECIFIED
+
+    response = function.Response(fnv1.RunFunctionRequest(), fnv1.RunFunctionResponse())
+    assert fnv1.RunFunctionResponse.FromString(response.SerializeToString()) == response.message()
+
+
+RECEIVED = """
+class Composite(BaseComposite):
+    def compose(self):
+        self.resources.bucket('s3.aws.upbound.io/v1beta1', 'Bucket').spec.region = 'us-east-1'
+        self.context.composed = True
+        self.status.received = sorted(name for name, _ in self.request.desired.resources)
+        self.status.iteration = self.request.context.iteration
+        self.status.composed = self.request.context.composed
+"""
+
+
+@pytest.mark.asyncio
+async def test_request_received():
+    for serialized in (False, True):
+        request = fnv1.RunFunctionRequest()
+        request.observed.composite.resource.update({
+            'apiVersion': 'example.crossplane.io/v1',
+            'kind': 'XR',
+            'metadata': {'name': 'received'},
+        })
+        request.desired.resources['previous'].resource.update({'kind': 'ConfigMap'})
+        request.context.update({'iteration': 1})
+        request.input['composite'] = RECEIVED
+        data = request.SerializeToString() if serialized else None
+        runner = function.FunctionRunner()
+        response = (await runner.ServeFunction(request, None, data)).message()
+        # The composite reads the desired state and context from the previous step, not as composed
+        status = response.desired.composite.resource['status']
+        assert list(status['received']) == ['previous']
+        assert status['iteration'] == 1
+        assert 'composed' not in status
+        assert sorted(response.desired.resources) == ['bucket', 'previous']
+        assert response.context['iteration'] == 2 and response.context['composed']
+
+
+def test_class_names():
+    runner = function.FunctionRunner()
+    scripts = [f"class Composite(BaseComposite):\n    VALUE = {ix}\n" for ix in range(2)]
+    for composite in [*scripts, 'tests.fn_cases.clazz.TestComposite']:
+        clazz, _ = runner.get_clazz(composite, function.logger)
+        assert clazz
+    # Inline scripts are named apart by a digest of their source
+    names = [runner.names[script] for script in scripts]
+    assert names[0] != names[1]
+    assert all(name.startswith('<script ') and name.endswith('>.Composite') for name in names)
+    assert runner.names['tests.fn_cases.clazz.TestComposite'] == 'tests.fn_cases.clazz.TestComposite'
+
+
+@pytest.mark.asyncio
+async def test_warm_up(tmp_path):
+    script = (pathlib.Path(__file__).parent / 'fn_cases' / 'clazz.py').read_text().replace('TestComposite', 'Composite')
+    script_file = tmp_path / 'composite.py'
+    script_file.write_text(script)
+    runner = function.FunctionRunner()
+    loaded = await runner.warm_up(
+        ['tests.fn_cases.clazz.TestComposite', str(script_file), 'tests.fn_cases.clazz.Missing'],
+        compose=True,
+    )
+    assert loaded == 2
+    assert function.LOG_FIELDS.get() is None
+    assert 'tests.fn_cases.clazz.TestComposite' in runner.clazzes
+    assert script in runner.clazzes
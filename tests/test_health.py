@@ -0,0 +1,49 @@
+import asyncio
+import sys
+
+import pytest
+from grpc_health.v1 import health_pb2
+
+from crossplane.pythonic import function, main, packages
+
+
+async def status(server):
+    response = await server.health.Check(health_pb2.HealthCheckRequest(service=function.SERVICE_NAME), None)
+    return response.status
+
+
+@pytest.mark.asyncio
+async def test_health_gating(tmp_path, monkeypatch):
+    release = asyncio.Event()
+
+    async def operator(stop, runner, secrets, namespaces, directory, synced, *_):
+        await release.wait()
+        synced.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(packages, 'operator', operator)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    server = main.Main()
+    args = server.parse_args([
+        '--insecure',
+        '--address', '127.0.0.1:0',
+        '--packages',
+        '--packages-watcher', 'builtin',
+        '--packages-dir', str(tmp_path),
+    ])
+    running = asyncio.create_task(server.run(args))
+    try:
+        while not hasattr(server, 'health'):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        assert await status(server) == health_pb2.HealthCheckResponse.NOT_SERVING
+        release.set()
+        for _ in range(100):
+            if await status(server) == health_pb2.HealthCheckResponse.SERVING:
+                break
+            await asyncio.sleep(0.01)
+        assert await status(server) == health_pb2.HealthCheckResponse.SERVING
+    finally:
+        await server.stop(0)
+        await asyncio.wait_for(running, 5)
+    assert await status(server) == health_pb2.HealthCheckResponse.NOT_SERVING
@@ -0,0 +1,52 @@
+import json
+import logging
+import queue
+import sys
+
+from crossplane.pythonic import function, main
+
+
+def record(name, message, *args, exc_info=None):
+    return logging.LogRecord(name, logging.INFO, __file__, 1, message, args, exc_info)
+
+
+def test_formatter_name():
+    formatter = main.Formatter(20)
+    assert formatter.sname('com.example.XR.my-composite-name') == 'c.e.X.composite-name'
+    assert formatter.sname('short.name') == 'short.name'
+    message = formatter.format(record('com.example.XR.my-composite-name', 'Hello'))
+    assert ' c.e.X.composite-name [INFO    ] Hello' in message
+    assert formatter.snames == {'com.example.XR.my-composite-name': 'c.e.X.composite-name'}
+
+
+def test_queue_handler():
+    records = queue.SimpleQueue()
+    handler = main.QueueHandler(records)
+    try:
+        raise ValueError('failed')
+    except ValueError:
+        exc_info = sys.exc_info()
+    fields = {'xr': 'example.com/v1/XR/test', 'class': 'example.Composite'}
+    token = function.LOG_FIELDS.set(fields)
+    try:
+        handler.emit(record('test', 'Hello %s', 'world', exc_info=exc_info))
+        fields['iteration'] = 2
+    finally:
+        function.LOG_FIELDS.reset(token)
+    queued = records.get_nowait()
+    assert queued.msg == 'Hello world'
+    assert queued.args is None
+    # The traceback is formatted, its frames are not kept alive by the queue
+    assert queued.exc_info is None
+    assert queued.exc_text.endswith('ValueError: failed')
+    assert 'ValueError: failed' in main.Formatter(20).format(queued)
+
+    entry = json.loads(main.JsonFormatter().format(queued))
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'test'
+    assert entry['message'] == 'Hello world'
+    assert entry['xr'] == 'example.com/v1/XR/test'
+    assert entry['class'] == 'example.Composite'
+    assert entry['exception'].endswith('ValueError: failed')
+    # Fields added after the record was logged are not included
+    assert 'iteration' not in entry
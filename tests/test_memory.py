@@ -0,0 +1,62 @@
+import sys
+import tracemalloc
+
+import pytest
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from crossplane.pythonic import function, memory
+
+
+SCRIPT = """
+RETAINED = []
+
+class Composite(BaseComposite):
+    def compose(self):
+        RETAINED.append(bytearray(100000))
+"""
+
+TRANSIENT = """
+class Composite(BaseComposite):
+    def compose(self):
+        self.buffer = bytearray(100000)
+"""
+
+
+@pytest.mark.asyncio
+async def test_memory_profile(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'tests.fn_cases.clazz', raising=False)
+    tracing = tracemalloc.is_tracing()
+    runner = function.FunctionRunner()
+    runner.memory = memory.MemoryProfiler(True, top=3)
+    try:
+        for script, count in ((SCRIPT, 2), (TRANSIENT, 200)):
+            for ix in range(count):
+                request = fnv1.RunFunctionRequest()
+                request.observed.composite.resource.update({
+                    'apiVersion': 'example.crossplane.io/v1',
+                    'kind': 'XR',
+                    'metadata': {'name': 'leaky'},
+                })
+                request.input['composite'] = script
+                await runner.run_function(request)
+        await runner.warm_up(['tests.fn_cases.clazz.TestComposite'])
+        report = await runner.memory.report(runner)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    stats = report['classes'][function.className(SCRIPT, runner.clazzes[SCRIPT])]
+    assert stats['composes'] == 2
+    assert stats['retained'] >= 200000
+    # The objects of finished composes are not counted
+    stats = report['classes'][function.className(TRANSIENT, runner.clazzes[TRANSIENT])]
+    assert stats['composes'] == 200
+    assert 0 <= stats['retained'] < 10000
+    assert report['clazzes']['count'] == 3
+    assert 'tests.fn_cases.clazz' in report['modules']
+    assert len(report['top']) == 3
+    assert report['top'][0]['size'] >= 200000
+
+
+def test_memory_disabled():
+    assert memory.MemoryProfiler().compose('example.Composite', None) is memory.NOT_ACCOUNTING
@@ -0,0 +1,537 @@
+import asyncio
+import base64
+import functools
+import importlib
+import io
+import inspect
+import json
+import logging
+import os
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+from crossplane.pythonic import function, importer, kube, packages
+
+
+def configmap(data, name='package'):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'ConfigMap',
+        'metadata': {
+            'namespace': 'default',
+            'name': name,
+            'labels': {'function-pythonic.package': 'batched'},
+        },
+        'data': data,
+    }
+
+
+@pytest.mark.asyncio
+async def test_batched_invalidation(tmp_path, monkeypatch):
+    runner = function.FunctionRunner()
+    batches = []
+    invalidate_modules = runner.invalidate_modules
+    def record(modules):
+        batches.append(modules)
+        invalidate_modules(modules)
+    monkeypatch.setattr(runner, 'invalidate_modules', record)
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', packages.Generations(tmp_path))
+    monkeypatch.setattr(packages, 'INVALIDATE_DELAY', 0.05)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    logger = logging.getLogger(__name__)
+
+    old = configmap({f"module{ix}.py": f"VALUE = {ix}\n" for ix in range(30)})
+    await packages.create(old, logger)
+    await packages.create(configmap({'other.py': 'VALUE = 0\n'}, 'other'), logger)
+    assert batches == []
+    await asyncio.sleep(0.1)
+    assert len(batches) == 1
+    assert len(batches[0]) == 31
+    assert packages.PACKAGES['ConfigMap/default/package']['files'][0] == 'module0.py'
+
+    new = configmap({**old['data'], 'module1.py': 'VALUE = 100\n'})
+    await packages.update(new, old, logger)
+    await packages.update(new, new, logger)
+    await asyncio.sleep(0.1)
+    assert batches[1] == ['batched.module1']
+    assert (tmp_path / 'current' / 'batched' / 'module1.py').read_text() == 'VALUE = 100\n'
+
+    await packages.delete(new, logger)
+    await packages.delete(configmap({'other.py': ''}, 'other'), logger)
+    packages.flush_invalidations()
+    assert len(batches) == 3
+    assert 'batched' in batches[2]
+    assert not (tmp_path / 'current' / 'batched').exists()
+    assert packages.PACKAGES == {}
+
+
+@pytest.mark.asyncio
+async def test_package_generations(tmp_path, monkeypatch):
+    runner = function.FunctionRunner()
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', packages.Generations(tmp_path))
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    logger = logging.getLogger(__name__)
+
+    old = configmap({'__init__.py': '', 'first.py': 'VALUE = 1\n', 'second.py': 'VALUE = 2\n'})
+    await packages.create(old, logger)
+    packages.flush_invalidations()
+    first = packages.STORE.published
+    assert (tmp_path / 'current').resolve() == first
+    assert str(first) in sys.path
+    try:
+        import batched.first
+        import batched.second
+        assert batched.first.VALUE == 1
+
+        # Staged changes are not visible until published
+        new = configmap({**old['data'], 'first.py': 'VALUE = 10\n'})
+        await packages.update(new, old, logger)
+        assert (first / 'batched' / 'first.py').read_text() == 'VALUE = 1\n'
+        runner.inflight[1] = (0, {})
+        packages.flush_invalidations()
+        second = packages.STORE.published
+        assert (tmp_path / 'current').resolve() == second
+        # The hard linked manifest of the previous generation is not rewritten
+        manifest = json.loads((first / packages.MANIFEST).read_text())
+        assert manifest != json.loads((second / packages.MANIFEST).read_text())
+        assert str(first) not in sys.path and str(second) in sys.path
+        # Only the changed module is unloaded, the unchanged modules move to the published generation
+        assert 'batched.first' not in sys.modules
+        unchanged = sys.modules['batched.second']
+        assert unchanged.__file__ == str(second / 'batched' / 'second.py')
+        assert sys.modules['batched'].__path__ == [str(second / 'batched')]
+        import batched.first
+        import batched.second
+        assert batched.first.VALUE == 10
+        assert batched.first.__file__.startswith(str(second))
+        assert batched.second is unchanged
+
+        # The previous generation is removed after the in-flight requests complete
+        await asyncio.sleep(0)
+        assert first.is_dir()
+        runner.completed(1)
+        await asyncio.gather(*packages.STORE.collecting)
+        assert not first.exists()
+        # New submodules of unchanged packages are found once the previous generation is removed
+        await packages.update(configmap({**new['data'], 'third.py': 'VALUE = 3\n'}), new, logger)
+        packages.flush_invalidations()
+        import batched.third
+        assert batched.third.VALUE == 3
+        # Nothing staged to publish still clears the pending invalidations
+        packages.INVALIDATE_PENDING.add('batched.third')
+        packages.flush_invalidations()
+        assert not packages.INVALIDATE_PENDING
+        assert batched.third is sys.modules['batched.third']
+    finally:
+        for module in ('batched', 'batched.first', 'batched.second', 'batched.third'):
+            sys.modules.pop(module, None)
+
+
+@pytest.mark.asyncio
+async def test_in_memory_packages(monkeypatch):
+    runner = function.FunctionRunner()
+    store = importer.PackageImporter()
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', store)
+    monkeypatch.setattr(sys, 'meta_path', list(sys.meta_path))
+    store.install()
+    logger = logging.getLogger(__name__)
+
+    old = configmap({'__init__.py': 'NAME = "batched"\n', 'composite.py': 'from . import NAME\nVALUE = 1\n'})
+    nested = configmap({'leaf.py': 'VALUE = 3\n'}, 'nested')
+    nested['metadata']['labels']['function-pythonic.package'] = 'outer.inner'
+    await packages.create(old, logger)
+    await packages.create(nested, logger)
+    assert importlib.util.find_spec('batched') is None
+    packages.flush_invalidations()
+    try:
+        import batched.composite
+        import outer.inner.leaf
+        assert batched.composite.VALUE == 1
+        assert batched.composite.NAME == 'batched'
+        assert batched.composite.__file__ == '<packages>/batched/composite.py'
+        assert outer.inner.leaf.VALUE == 3
+        assert inspect.getsource(batched.composite).startswith('from . import NAME')
+        code = store.get_code('batched.composite')
+
+        await packages.update(configmap({**old['data'], 'composite.py': 'from . import NAME\nVALUE = 2\n'}), old, logger)
+        packages.flush_invalidations()
+        assert 'batched.composite' not in sys.modules
+        assert 'batched' in sys.modules and 'outer.inner.leaf' in sys.modules
+        assert store.get_code('batched.composite') is not code
+        import batched.composite
+        assert batched.composite.VALUE == 2
+
+        await packages.delete(nested, logger)
+        packages.flush_invalidations()
+        assert importlib.util.find_spec('outer') is None
+    finally:
+        for module in [name for name in sys.modules if name.split('.')[0] in ('batched', 'outer')]:
+            del sys.modules[module]
+
+
+@pytest.mark.asyncio
+async def test_resume_unchanged(tmp_path, monkeypatch):
+    runner = function.FunctionRunner()
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', packages.Generations(tmp_path))
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    logger = logging.getLogger(__name__)
+
+    first = configmap({'first.py': 'VALUE = 1\n', 'data.txt': 'text'})
+    second = configmap({'second.py': 'VALUE = 2\n'}, 'second')
+    second['metadata']['labels']['function-pythonic.package'] = 'removed.nested'
+    await packages.create(first, logger)
+    await packages.create(second, logger)
+    packages.flush_invalidations()
+    published = packages.STORE.published
+
+    # A restarted process reuses the published generation, only changes are written
+    store = packages.Generations(tmp_path)
+    monkeypatch.setattr(packages, 'STORE', store)
+    assert store.published == published
+    assert str(published) in sys.path
+    await packages.create(first, logger)
+    assert store.staging is None
+    assert packages.INVALIDATE_PENDING == set()
+    assert store.unseen() == [(['removed', 'nested'], 'second.py')]
+
+    changed = configmap({'first.py': 'VALUE = 10\n', 'data.txt': 'text'})
+    await packages.create(changed, logger)
+    assert packages.INVALIDATE_PENDING == {'batched.first'}
+    packages.flush_invalidations()
+    assert (tmp_path / 'current' / 'batched' / 'first.py').read_text() == 'VALUE = 10\n'
+    assert json.loads((tmp_path / 'current' / '.manifest.json').read_text()).keys() == {
+        'batched/data.txt', 'batched/first.py', 'removed/nested/second.py',
+    }
+
+
+def versioned(body, resourceVersion, data=None):
+    return {
+        **body,
+        'metadata': {**body['metadata'], 'resourceVersion': resourceVersion},
+        'data': body['data'] if data is None else data,
+    }
+
+
+class ListClient:
+    def __init__(self, items):
+        self.items = items
+
+    async def authenticate(self):
+        pass
+
+    async def list(self, resource, namespace=None, labelSelector=None):
+        assert labelSelector == packages.PACKAGE_LABEL
+        return self.items.get(resource, []), '10'
+
+
+@pytest.mark.asyncio
+async def test_sync_resume(tmp_path, monkeypatch):
+    runner = function.FunctionRunner()
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', packages.Generations(tmp_path))
+    monkeypatch.setattr(packages, 'PACKAGES', {})
+    monkeypatch.setattr(packages, 'SYNCED', {})
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    logger = logging.getLogger(__name__)
+
+    first = versioned(configmap({'first.py': 'VALUE = 1\n'}), '1')
+    second = versioned(configmap({'second.py': 'VALUE = 2\n'}, 'second'), '2')
+    listed = await packages.sync(False, [], ListClient({'configmaps': [first, second], 'secrets': [first]}))
+    assert listed == {('configmaps', None): ([first, second], '10')}
+    assert (tmp_path / 'current' / 'batched' / 'first.py').read_text() == 'VALUE = 1\n'
+    assert list(packages.SYNCED) == ['ConfigMap/default/package', 'ConfigMap/default/second']
+    published = packages.STORE.published
+
+    # kopf resumes the synced packages, only those changed since are written
+    await packages.resume(first, logger)
+    await packages.resume(versioned(second, '3', {'second.py': 'VALUE = 20\n'}), logger)
+    assert packages.SYNCED == {}
+    assert packages.INVALIDATE_PENDING == {'batched.second'}
+    packages.flush_invalidations()
+    assert packages.STORE.published != published
+    assert (tmp_path / 'current' / 'batched' / 'second.py').read_text() == 'VALUE = 20\n'
+
+    # Packages created after the sync are written
+    await packages.resume(versioned(configmap({'third.py': 'VALUE = 3\n'}, 'third'), '4'), logger)
+    assert packages.INVALIDATE_PENDING == {'batched.third'}
+    packages.flush_invalidations()
+
+    # The initial sync is retried until the API server responds
+    class FailingClient(ListClient):
+        async def list(self, resource, namespace=None, labelSelector=None):
+            if not failures:
+                failures.append(resource)
+                raise ConnectionRefusedError('API server unavailable')
+            return await super().list(resource, namespace, labelSelector)
+
+    failures = []
+    deleted = versioned(configmap({'deleted.py': 'VALUE = 4\n'}, 'deleted'), '5')
+    listed = await packages.initial_sync(False, [], FailingClient({'configmaps': [deleted]}), backoff=0)
+    assert failures == ['configmaps']
+    assert listed == {('configmaps', None): ([deleted], '10')}
+    # Packages deleted before kopf resumed them are forgotten
+    assert list(packages.SYNCED) == ['ConfigMap/default/deleted']
+    packages.expire_synced()
+    assert packages.SYNCED == {}
+    packages.flush_invalidations()
+
+
+def test_kubeconfig_plugins(tmp_path, monkeypatch):
+    kubeconfig = tmp_path / 'kubeconfig'
+    kubeconfig.write_text(json.dumps({
+        'current-context': 'plugin',
+        'contexts': [{'name': 'plugin', 'context': {'cluster': 'plugin', 'user': 'plugin'}}],
+        'clusters': [{'name': 'plugin', 'cluster': {'server': 'https://127.0.0.1:6443'}}],
+        'users': [{'name': 'plugin', 'user': {'exec': {'command': 'aws', 'args': ['eks', 'get-token']}}}],
+    }))
+    monkeypatch.setenv('KUBECONFIG', str(kubeconfig))
+    monkeypatch.delenv('KUBERNETES_SERVICE_HOST', raising=False)
+    with pytest.raises(kube.Unsupported):
+        kube.client()
+
+
+def test_certificate_files(tmp_path):
+    loaded = []
+
+    class Context:
+        def load_cert_chain(self, certificate, key):
+            with open(key, 'rb') as file:
+                loaded.append((certificate, key, file.read()))
+
+    kube.loadCertificate(Context(), str(tmp_path / 'tls.crt'), None, None, b'key')
+    [(certificate, key, data)] = loaded
+    assert certificate == str(tmp_path / 'tls.crt')
+    assert data == b'key'
+    # The key data is only on disk while it is loaded
+    assert not os.path.exists(key)
+
+
+@pytest.mark.asyncio
+async def test_reload_classes(monkeypatch):
+    runner = function.FunctionRunner()
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', importer.PackageImporter())
+    monkeypatch.setattr(sys, 'meta_path', list(sys.meta_path))
+    packages.STORE.install()
+    logger = logging.getLogger(__name__)
+
+    other = 'class Composite(BaseComposite):\n    VALUE = 3\n'
+    script = 'from crossplane.pythonic import BaseComposite\nclass Composite(BaseComposite):\n    pass\n'
+    old = configmap({'composite.py': 'class Composite(BaseComposite):\n    VALUE = 1\n', 'other.py': other})
+    await packages.create(old, logger)
+    packages.flush_invalidations()
+    try:
+        clazz, _ = runner.get_clazz('batched.composite.Composite', function.logger)
+        assert clazz.VALUE == 1
+        kept, _ = runner.get_clazz('batched.other.Composite', function.logger)
+        assert runner.get_clazz(script, function.logger)[0]
+
+        await packages.update(configmap({'composite.py': 'class Composite(BaseComposite):\n    VALUE = 2\n', 'other.py': other}), old, logger)
+        packages.flush_invalidations()
+        # Only the classes of the changed modules are reloaded, inline scripts compile on next use
+        assert runner.clazzes == {'batched.other.Composite': kept}
+        await asyncio.gather(*packages.RELOADING)
+        assert runner.clazzes.keys() == {'batched.other.Composite', 'batched.composite.Composite'}
+        assert runner.clazzes['batched.composite.Composite'].VALUE == 2
+        assert runner.hits['batched.composite.Composite'] == 0
+    finally:
+        for module in [name for name in sys.modules if name.split('.')[0] == 'batched']:
+            del sys.modules[module]
+
+
+def bundle(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as archive:
+        for name, text in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(text)
+            archive.addfile(info, io.BytesIO(text.encode('utf-8')))
+    return base64.b64encode(data.getvalue()).decode('utf-8')
+
+
+@pytest.mark.asyncio
+async def test_bundle(tmp_path, monkeypatch):
+    runner = function.FunctionRunner()
+    monkeypatch.setattr(packages, 'GRPC_RUNNER', runner)
+    monkeypatch.setattr(packages, 'STORE', packages.Generations(tmp_path))
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    logger = logging.getLogger(__name__)
+
+    old = configmap({})
+    old['binaryData'] = {'library.tar.gz': bundle({
+        '__init__.py': '',
+        'first.py': 'VALUE = 1\n',
+        'sub/__init__.py': '',
+        'sub/second.py': 'from .. import first\nVALUE = first.VALUE + 1\n',
+        '../escape.py': '',
+    })}
+    await packages.create(old, logger)
+    assert packages.INVALIDATE_PENDING == {'batched', 'batched.first', 'batched.sub', 'batched.sub.second'}
+    packages.flush_invalidations()
+    try:
+        import batched.sub.second
+        assert batched.sub.second.VALUE == 2
+        assert not (tmp_path / 'escape.py').exists()
+
+        new = configmap({})
+        new['binaryData'] = {'library.zip': base64.b64encode(zipped({
+            '__init__.py': '',
+            'first.py': 'VALUE = 10\n',
+        })).decode('utf-8')}
+        await packages.update(new, old, logger)
+        packages.flush_invalidations()
+        assert not (tmp_path / 'current' / 'batched' / 'sub').exists()
+        assert 'batched.sub.second' not in sys.modules
+        import batched.first
+        assert batched.first.VALUE == 10
+    finally:
+        for module in [name for name in sys.modules if name.split('.')[0] == 'batched']:
+            del sys.modules[module]
+
+
+def zipped(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, text in files.items():
+            archive.writestr(name, text)
+    return data.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_builtin_watcher(tmp_path, monkeypatch):
+    from aiohttp import web
+
+    def listed(items, resourceVersion):
+        return web.json_response({'kind': 'ConfigMapList', 'metadata': {'resourceVersion': resourceVersion}, 'items': items})
+
+    def modified(body, resourceVersion, data):
+        return {**body, 'metadata': {**body['metadata'], 'resourceVersion': resourceVersion}, 'data': data}
+
+    first = modified(configmap({'first.py': 'VALUE = 1\n'}), '1', {'first.py': 'VALUE = 1\n'})
+    second = modified(configmap({'second.py': 'VALUE = 2\n'}, 'second'), '15', {'second.py': 'VALUE = 2\n'})
+    lists = [listed([first], '10'), listed([second], '20')]
+    watches = []
+    watching = asyncio.Event()
+    stopping = asyncio.Event()
+
+    async def configmaps(request):
+        assert request.query['labelSelector'] == 'function-pythonic.package'
+        if 'watch' not in request.query:
+            return lists.pop(0)
+        watches.append(request.query.get('resourceVersion'))
+        if len(watches) == 3:
+            return web.Response(status=500)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        if len(watches) == 1:
+            events = [
+                {'type': 'MODIFIED', 'object': modified(first, '11', {'first.py': 'VALUE = 11\n'})},
+                {'type': 'BOOKMARK', 'object': {'kind': 'ConfigMap', 'metadata': {'resourceVersion': '12'}}},
+            ]
+        elif len(watches) == 2:
+            events = [{'type': 'ERROR', 'object': {'kind': 'Status', 'code': 410, 'message': 'too old'}}]
+        else:
+            watching.set()
+            await stopping.wait()
+            events = []
+        for event in events:
+            await response.write(json.dumps(event).encode('utf-8') + b'\n')
+        return response
+
+    app = web.Application()
+    app.router.add_get('/api/v1/configmaps', configmaps)
+    server = web.AppRunner(app)
+    await server.setup()
+    site = web.TCPSite(server, '127.0.0.1', 0)
+    await site.start()
+    port = server.addresses[0][1]
+    kubeconfig = tmp_path / 'kubeconfig'
+    kubeconfig.write_text(json.dumps({
+        'current-context': 'fake',
+        'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+        'clusters': [{'name': 'fake', 'cluster': {'server': f"http://127.0.0.1:{port}"}}],
+        'users': [{'name': 'fake', 'user': {'token': 'token'}}],
+    }))
+    monkeypatch.setenv('KUBECONFIG', str(kubeconfig))
+    monkeypatch.delenv('KUBERNETES_SERVICE_HOST', raising=False)
+    for name in ('GRPC_STOP', 'GRPC_RUNNER', 'PACKAGES_DIR', 'STORE', 'INVALIDATE_DELAY'):
+        monkeypatch.setattr(packages, name, getattr(packages, name))
+    monkeypatch.setattr(packages, 'PACKAGES', {})
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    # Retry the failed watch without waiting out the backoff
+    monkeypatch.setattr(kube, 'Watcher', functools.partial(kube.Watcher, backoff=0))
+
+    synced = asyncio.Event()
+    operator = asyncio.create_task(packages.operator(
+        None, function.FunctionRunner(), False, [], tmp_path / 'packages', synced, 0.01, False, 'builtin',
+    ))
+    try:
+        await asyncio.wait_for(synced.wait(), 5)
+        current = tmp_path / 'packages' / 'current' / 'batched'
+        assert (current / 'first.py').read_text() == 'VALUE = 1\n'
+        await asyncio.wait_for(watching.wait(), 10)
+        # Resumed from the bookmark, relisted after the 410, retried after the 500
+        assert watches == ['10', '12', '20', '20']
+        packages.flush_invalidations()
+        assert not (current / 'first.py').exists()
+        assert (current / 'second.py').read_text() == 'VALUE = 2\n'
+        assert list(packages.PACKAGES) == ['ConfigMap/default/second']
+    finally:
+        stopping.set()
+        operator.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await operator
+        await server.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_watcher_token_rotation(tmp_path):
+    from aiohttp import web
+
+    token = tmp_path / 'token'
+    token.write_text('expired\n')
+    rejected = []
+    created = asyncio.Event()
+    stopping = asyncio.Event()
+
+    async def configmaps(request):
+        if request.headers.get('Authorization') != 'Bearer rotated':
+            rejected.append(request.headers.get('Authorization'))
+            if len(rejected) == 2:
+                # The kubelet rotates the projected token
+                token.write_text('rotated\n')
+            return web.Response(status=401)
+        if 'watch' in request.query:
+            await stopping.wait()
+        return web.json_response({'kind': 'ConfigMapList', 'metadata': {'resourceVersion': '1'}, 'items': [configmap({})]})
+
+    async def create(body):
+        created.set()
+
+    app = web.Application()
+    app.router.add_get('/api/v1/configmaps', configmaps)
+    server = web.AppRunner(app)
+    await server.setup()
+    site = web.TCPSite(server, '127.0.0.1', 0)
+    await site.start()
+    login = functools.partial(kube.tokenCredentials, token)
+    client = kube.Client(f"http://127.0.0.1:{server.addresses[0][1]}", None, *login(), login)
+    watcher = kube.Watcher(client, 'configmaps', None, None, create, None, None, backoff=0)
+    task = asyncio.create_task(watcher.run())
+    try:
+        await asyncio.wait_for(created.wait(), 5)
+        assert rejected == ['Bearer expired', 'Bearer expired']
+    finally:
+        stopping.set()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await client.close()
+        await server.cleanup()
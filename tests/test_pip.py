@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+from crossplane.pythonic import main
+
+
+def test_pip_lock(tmp_path):
+    requirements = tmp_path / 'requirements.txt'
+    requirements.write_text('aiobotocore==2.23.2\n')
+    assert list(main.pip_files(['-r', 'a.txt', '-rb.txt', '-c=c.txt', '--constraint=d.txt', '--constraint', 'e.txt', 'f'])) == [
+        'a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt',
+    ]
+    for args in (['-r', str(requirements)], [f"-r={requirements}"], [f"--requirement={requirements}"]):
+        before = main.pip_lock(args)
+        requirements.write_text('aiobotocore==2.23.3\n')
+        assert main.pip_lock(args) != before
+        requirements.write_text('aiobotocore==2.23.2\n')
+        assert main.pip_lock(args) == before
+
+
+def test_pip_install_cached(tmp_path, monkeypatch):
+    runs = []
+
+    def run_pip(*args):
+        runs.append(args[0])
+        if args[0] == 'install':
+            if '--no-index' in args and len(runs) == 1:
+                raise subprocess.CalledProcessError(1, 'pip')
+            target = args[args.index('--target') + 1]
+            os.makedirs(target, exist_ok=True)
+            with open(os.path.join(target, 'cached_module.py'), 'w') as file:
+                file.write('VALUE = 1\n')
+
+    monkeypatch.setattr(main, 'run_pip', run_pip)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    action = main.pip_install_cached(['cached-module==1'], tmp_path)
+    assert action.startswith('Installed lock') and action.endswith('from downloaded wheels')
+    assert runs == ['install', 'wheel', 'install']
+    environment = tmp_path / 'environments' / main.pip_lock(['cached-module==1'])
+    # Appended, installed packages do not shadow the standard library
+    assert sys.path[-1] == str(environment)
+
+    runs.clear()
+    assert main.pip_install_cached(['cached-module==1'], tmp_path).startswith('Reused lock')
+    assert runs == []
+
+    # Only the most recently used environments are kept
+    for version in range(2, 6):
+        main.pip_install_cached([f"cached-module=={version}"], tmp_path)
+    environments = sorted(path.name for path in (tmp_path / 'environments').iterdir())
+    assert len(environments) == main.PIP_ENVIRONMENTS
+    assert environment.name not in environments
+    assert main.pip_lock(['cached-module==5']) in environments
+
+
+def test_pip_collect_abandoned(tmp_path):
+    environments = tmp_path / 'environments'
+    current = environments / 'current'
+    current.mkdir(parents=True)
+    (current / '.complete').write_text('')
+    installing = environments / 'other.1234'
+    installing.mkdir()
+    os.utime(installing, (0, 0))
+    main.pip_collect(current)
+    assert sorted(path.name for path in environments.iterdir()) == ['current']
@@ -0,0 +1,57 @@
+import pstats
+
+import pytest
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from crossplane.pythonic import function, profiling
+
+
+SCRIPT = """
+import time
+
+class Composite(BaseComposite):
+    def compose(self):
+        time.sleep(0.02)
+"""
+
+
+def request(name):
+    request = fnv1.RunFunctionRequest()
+    request.observed.composite.resource.update({
+        'apiVersion': 'example.crossplane.io/v1',
+        'kind': 'XR',
+        'metadata': {'name': name},
+    })
+    request.input['composite'] = SCRIPT
+    return request
+
+
+@pytest.mark.asyncio
+async def test_profile_filter(tmp_path):
+    runner = function.FunctionRunner()
+    runner.profiler = profiling.Profiler(tmp_path, filter='/profiled$')
+    await runner.run_function(request('profiled'))
+    await runner.run_function(request('other'))
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1
+    name = profiling.filename(runner.names[SCRIPT])
+    assert name.startswith('_script_') and name.endswith('_.Composite')
+    assert files[0].name.endswith(f"-example.crossplane.io_v1_XR_profiled-{name}.pstats")
+    assert any(function[2] == 'compose' for function in pstats.Stats(str(files[0])).stats)
+
+
+@pytest.mark.asyncio
+async def test_profile_threshold(tmp_path):
+    runner = function.FunctionRunner()
+    runner.profiler = profiling.Profiler(tmp_path, threshold=0.01)
+    await runner.run_function(request('slow'))
+    assert runner.profiler.armed == {'example.crossplane.io/v1/XR/slow'}
+    assert not list(tmp_path.iterdir())
+    await runner.run_function(request('slow'))
+    assert runner.profiler.profiled == 1
+    assert not runner.profiler.armed
+
+    runner.profiler.enabled = False
+    runner.profiler.sample = 1.0
+    await runner.run_function(request('slow'))
+    assert runner.profiler.profiled == 1
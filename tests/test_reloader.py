@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from crossplane.pythonic import function, reloader
+
+
+COMPOSITE = '''from crossplane.pythonic import BaseComposite
+import hothelper
+class Composite(BaseComposite):
+    VALUE = hothelper.VALUE
+'''
+
+
+def volume(root, version, files):
+    """Update a directory the way kubelet updates a ConfigMap volume."""
+    data = root / f"..{version}"
+    data.mkdir()
+    for name, text in files.items():
+        (data / name).write_text(text)
+        if not (root / name).is_symlink():
+            (root / name).symlink_to(f"..data/{name}")
+    (root / '..data_tmp').symlink_to(data.name)
+    os.replace(root / '..data_tmp', root / '..data')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('poll', [None, 0.05])
+async def test_path_reload(tmp_path, monkeypatch, poll):
+    monkeypatch.setattr(sys, 'path', [str(tmp_path), *sys.path])
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    files = {'hotcomposite.py': COMPOSITE, 'hothelper.py': 'VALUE = 1\n', 'hotother.py': 'VALUE = 1\n'}
+    volume(tmp_path, 1, files)
+    runner = function.FunctionRunner()
+    try:
+        clazz, _ = runner.get_clazz('hotcomposite.Composite', function.logger)
+        assert clazz.VALUE == 1
+        other = __import__('hotother')
+
+        path_reloader = reloader.PathReloader(runner, [tmp_path], poll, 0.01)
+        assert path_reloader.files.keys() == {str(tmp_path / name) for name in files}
+        task = asyncio.create_task(path_reloader.run())
+        await asyncio.sleep(0.1)
+        volume(tmp_path, 2, {**files, 'hothelper.py': 'VALUE = 2\n'})
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            clazz = runner.clazzes.get('hotcomposite.Composite')
+            if clazz and clazz.VALUE == 2:
+                break
+        task.cancel()
+        # The changed module and its dependent are reloaded, other modules are kept
+        assert runner.clazzes['hotcomposite.Composite'].VALUE == 2
+        assert runner.hits['hotcomposite.Composite'] == 0
+        assert sys.modules['hotother'] is other
+    finally:
+        for module in ('hotcomposite', 'hothelper', 'hotother'):
+            sys.modules.pop(module, None)
+
+
+def test_module_name():
+    assert reloader.moduleName('example/features.py') == 'example.features'
+    assert reloader.moduleName('example/__init__.py') == 'example'
+    assert reloader.moduleName('not-a-module.py') is None
@@ -0,0 +1,129 @@
+import yaml
+
+from crossplane.pythonic import render
+
+
+COMPOSITION = '''
+apiVersion: apiextensions.crossplane.io/v1
+kind: Composition
+metadata:
+  name: render
+spec:
+  compositeTypeRef:
+    apiVersion: example.crossplane.io/v1
+    kind: XR
+  mode: Pipeline
+  pipeline:
+  - step: bucket
+    functionRef:
+      name: function-pythonic
+    input:
+      apiVersion: pythonic.fn.fortra.com/v1alpha1
+      kind: Composite
+      composite: |
+        class Composite(BaseComposite):
+          def compose(self):
+            if self.spec.fail:
+              self.events.fatal('Failed', 'Requested failure')
+              return
+            bucket = self.resources.bucket('s3.aws.upbound.io/v1beta1', 'Bucket')
+            bucket.spec.forProvider.region = self.spec.region
+            self.context.region = self.spec.region
+  - step: auto-ready
+    functionRef:
+      name: function-auto-ready
+  - step: tags
+    functionRef:
+      name: crossplane-contrib-function-pythonic
+    input:
+      apiVersion: pythonic.fn.fortra.com/v1alpha1
+      kind: Composite
+      composite: |
+        class Composite(BaseComposite):
+          def compose(self):
+            config = self.requireds.config('v1', 'ConfigMap', 'default', 'tags')
+            self.resources.bucket.spec.forProvider.tags.team = config[0].data.team
+            self.status.region = self.context.region
+'''
+
+XRS = '''
+apiVersion: example.crossplane.io/v1
+kind: XR
+metadata:
+  name: first
+spec:
+  region: us-east-1
+---
+apiVersion: example.crossplane.io/v1
+kind: XR
+metadata:
+  name: failed
+spec:
+  fail: true
+---
+apiVersion: example.crossplane.io/v1
+kind: XR
+metadata:
+  name: second
+spec:
+  region: us-west-2
+'''
+
+EXTRA = '''
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  namespace: default
+  name: tags
+data:
+  team: platform
+'''
+
+
+def test_render(tmp_path, capsys, caplog):
+    (tmp_path / 'composition.yaml').write_text(COMPOSITION)
+    (tmp_path / 'xrs.yaml').write_text(XRS)
+    (tmp_path / 'extra.yaml').write_text(EXTRA)
+
+    code = render.main([
+        str(tmp_path / 'xrs.yaml'),
+        str(tmp_path / 'composition.yaml'),
+        '--extra-resources', str(tmp_path / 'extra.yaml'),
+        '--function-name', 'function-pythonic',
+        '--function-name', 'crossplane-contrib-function-pythonic',
+        '--include-context',
+    ])
+    output = capsys.readouterr()
+    assert code == 1
+    assert 'Render of XR/failed failed: step bucket: Requested failure' in output.err
+    assert 'Skipping step auto-ready' in caplog.text
+
+    documents = list(yaml.safe_load_all(output.out))
+    assert [(document['kind'], document.get('metadata', {}).get('name')) for document in documents] == [
+        ('XR', 'first'), ('Bucket', None), ('Context', None),
+        ('XR', 'second'), ('Bucket', None), ('Context', None),
+    ]
+    xr, bucket, context = documents[:3]
+    assert xr['status']['region'] == 'us-east-1'
+    assert bucket['spec']['forProvider'] == {'region': 'us-east-1', 'tags': {'team': 'platform'}}
+    assert bucket['metadata']['generateName'] == 'first-'
+    assert bucket['metadata']['annotations'] == {'crossplane.io/composition-resource-name': 'bucket'}
+    assert context['fields']['region'] == 'us-east-1'
+    assert documents[4]['spec']['forProvider']['region'] == 'us-west-2'
+
+
+def test_selected():
+    extra = yaml.safe_load(EXTRA)
+    selector = render.fnv1.ResourceSelector(api_version='v1', kind='ConfigMap', match_name='tags')
+    assert render.selected(selector, extra)
+    selector.namespace = 'other'
+    assert not render.selected(selector, extra)
+    selector = render.fnv1.ResourceSelector(api_version='v1', kind='ConfigMap')
+    selector.match_labels.labels['team'] = 'platform'
+    assert not render.selected(selector, extra)
+
+
+def test_render_no_composition(tmp_path, capsys):
+    (tmp_path / 'xrs.yaml').write_text(XRS)
+    assert render.main([str(tmp_path / 'xrs.yaml'), str(tmp_path / 'xrs.yaml')]) == 1
+    assert f"Render failed: No Composition found in {tmp_path / 'xrs.yaml'}" in capsys.readouterr().err
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from crossplane.function.proto.v1 import run_function_pb2 as fnv1
+
+from crossplane.pythonic import function, tracing
+
+
+SCRIPT = """
+class Composite(BaseComposite):
+    def compose(self):
+        with self.span('buckets', count=2):
+            self.resources.bucket('s3.aws.upbound.io/v1beta1', 'Bucket')
+"""
+
+
+@pytest.mark.asyncio
+async def test_trace_file(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+    tracing.configure(str(path))
+    try:
+        request = fnv1.RunFunctionRequest()
+        request.observed.composite.resource.update({
+            'apiVersion': 'example.crossplane.io/v1',
+            'kind': 'XR',
+            'metadata': {'name': 'traced'},
+        })
+        request.input['composite'] = SCRIPT
+        await function.FunctionRunner().run_function(request)
+    finally:
+        tracing.configure(None)
+
+    traces = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(traces) == 1
+    spans = traces[0]['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert [span['name'] for span in spans] == [
+        'input', 'load', 'instantiate', 'buckets', 'compose', 'requireds', 'unknowns', 'auto-ready', 'RunFunction',
+    ]
+    root = spans[-1]
+    assert 'parentSpanId' not in root
+    assert {'key': 'xr', 'value': {'stringValue': 'example.crossplane.io/v1/XR/traced'}} in root['attributes']
+    spans = {span['name']: span for span in spans}
+    assert all(span['traceId'] == root['traceId'] for span in spans.values())
+    assert spans['compose']['parentSpanId'] == root['spanId']
+    assert spans['buckets']['parentSpanId'] == spans['compose']['spanId']
+    assert spans['buckets']['attributes'] == [{'key': 'count', 'value': {'intValue': '2'}}]
+
+
+def test_not_recording():
+    assert tracing.span('idle') is tracing.NOT_RECORDING
+    with tracing.span('idle'):
+        assert tracing.current() is None